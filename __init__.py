@@ -33,11 +33,17 @@ bl_info = {
 # load and reload submodules
 ##################################
 
-modules = ["remesh",
+modules = ["profiling",
+           "kernel",
+           "mesh_arrays",
+           "voxel_remesh",
+           "remesh",
            "panels",
            "booleans",
            "deform",
-           "envelope_builder"]
+           "implicit",
+           "envelope_builder",
+           "flowretopo"]
 
 import importlib
 
@@ -57,9 +63,24 @@ import traceback
 def register():
     try:
         bpy.utils.register_module(__name__)
-        bpy.app.handlers.scene_update_pre.append(envelope_builder.del_loaded_profile_meshes)
         bpy.app.handlers.scene_update_pre.append(envelope_builder.update_envelope_preview)
         bpy.types.Armature.custom_preview_envelope = bpy.props.BoolProperty()
+        bpy.types.Armature.custom_preview_idle_delay = bpy.props.FloatProperty(
+            name="Preview Idle Delay", min=0, default=0.1,
+            description="Seconds the bones must stay still before the preview is rebuilt")
+        bpy.types.Armature.custom_preview_budget = bpy.props.FloatProperty(
+            name="Preview Time Budget", min=0.001, default=0.01,
+            description="Seconds of preview rebuild work allowed per scene update")
+        bpy.types.Armature.custom_preview_quality = bpy.props.IntProperty(
+            name="Preview Quality", min=0, max=envelope_builder.BoneProfile.max_level, default=1,
+            description="Profile level of detail of the biggest bones, smaller bones use coarser levels")
+        bpy.types.WindowManager.flow_profiling_expanded = bpy.props.BoolProperty()
+        bpy.types.WindowManager.flow_profiling_enabled = bpy.props.BoolProperty(
+            name="Record", update=panels.update_profiling,
+            description="Time the stages of the operators and the preview, this costs a little while on")
+        bpy.types.WindowManager.flow_profiling_memory = bpy.props.BoolProperty(
+            name="Memory", update=panels.update_profiling,
+            description="Also trace the allocations of every span, this slows every operator down noticeably")
     except:
         traceback.print_exc()
 
@@ -68,5 +89,12 @@ def unregister():
     try:
         bpy.utils.unregister_module(__name__)
         del bpy.types.Armature.custom_preview_envelope
+        del bpy.types.Armature.custom_preview_idle_delay
+        del bpy.types.Armature.custom_preview_budget
+        del bpy.types.Armature.custom_preview_quality
+        del bpy.types.WindowManager.flow_profiling_expanded
+        del bpy.types.WindowManager.flow_profiling_enabled
+        del bpy.types.WindowManager.flow_profiling_memory
+        profiling.profiler.configure(False)
     except:
         traceback.print_exc()
@@ -0,0 +1,241 @@
+# Benchmarks for the heavy parts of the addon.
+# They need a running blender, from the python console:
+#   from <addon module> import benchmarks
+#   benchmarks.run()
+# The same kernels run without blender in kernel_benchmarks.
+import numpy as np
+import bmesh
+import bpy
+from mathutils import kdtree
+from . import envelope_builder
+from . import implicit
+from . import kernel
+from . import voxel_remesh
+from . import flowretopo
+from .mesh_arrays import mesh_to_arrays
+from .kernel import face_edges
+from .kernel_benchmarks import synthetic_bones, timed
+
+
+def legacy_bones_to_bmesh(profile, bones, step_size, min_steps):
+    # The old per element path, kept here as the reference for the timings.
+    heads, tails, head_radii, tail_radii = kernel.bone_arrays(bones)
+    steps = kernel.bone_steps(heads, tails, step_size, min_steps)
+    faces = np.split(profile.loops, np.cumsum(profile.loop_totals)[:-1])
+    bm = bmesh.new()
+    for head, tail, head_radius, tail_radius, bone_steps in zip(heads, tails, head_radii, tail_radii, steps):
+        for step in range(bone_steps + 1):
+            factor = step / bone_steps
+            radius = head_radius + (tail_radius - head_radius) * factor
+            center = head + (tail - head) * factor
+            new_verts = [bm.verts.new(co * radius + center) for co in profile.co]
+            for face in faces:
+                bm.faces.new([new_verts[i] for i in face])
+    return bm
+
+
+def bench_bones_to_mesh(bone_counts=(10, 60, 200), step_size=0.05, min_steps=10):
+    profile = envelope_builder.profiles
+    results = []
+    for count in bone_counts:
+        bones = synthetic_bones(count)
+
+        legacy_mesh = bpy.data.meshes.new("bench_legacy")
+        legacy_time, bm = timed(legacy_bones_to_bmesh, profile, bones, step_size, min_steps)
+        legacy_time += timed(bm.to_mesh, legacy_mesh)[0]
+
+        mesh = bpy.data.meshes.new("bench_arrays")
+        array_time = timed(profile.bones_to_mesh, bones, step_size, min_steps, mesh, quality=0)[0]
+
+        assert len(mesh.vertices) == len(legacy_mesh.vertices)
+        assert len(mesh.polygons) == len(legacy_mesh.polygons)
+
+        results.append({"bones": count,
+                        "verts": len(mesh.vertices),
+                        "legacy": legacy_time,
+                        "arrays": array_time,
+                        "speedup": legacy_time / array_time})
+        bm.free()
+        bpy.data.meshes.remove(legacy_mesh)
+        bpy.data.meshes.remove(mesh)
+    return results
+
+
+def bench_polygonize(bone_counts=(10, 60, 200), voxel_sizes=(0.04, 0.02), blend=0.05):
+    results = []
+    for count in bone_counts:
+        bones = synthetic_bones(count)
+        field = implicit.CapsuleField(*kernel.bone_arrays(bones), blend=blend)
+        for voxel_size in voxel_sizes:
+            duration, (co, faces) = timed(implicit.polygonize, field, voxel_size)
+            results.append({"bones": count, "voxel_size": voxel_size,
+                            "verts": len(co), "faces": len(faces), "time": duration})
+    return results
+
+
+def source_mesh(closed=False):
+    # A monkey, or for closed sources a cube overlapping a sphere.
+    source = bpy.data.meshes.new("bench_source")
+    bm = bmesh.new()
+    if closed:
+        bmesh.ops.create_cube(bm, size=1.5)
+        sphere = bmesh.ops.create_uvsphere(bm, u_segments=32, v_segments=16, diameter=0.8)
+        bmesh.ops.translate(bm, vec=(0.6, 0.3, 0.4), verts=sphere["verts"])
+    else:
+        bmesh.ops.create_monkey(bm)
+    bm.to_mesh(source)
+    bm.free()
+    return source
+
+
+def remeshed_mesh(depth, mode="SMOOTH", closed=False):
+    # The source through the remesh modifier, the usual input of the remesh optimizer.
+    scene = bpy.context.scene
+    source = source_mesh(closed)
+    ob = bpy.data.objects.new("bench_source", source)
+    scene.objects.link(ob)
+    remesh_modifier = ob.modifiers.new(type="REMESH", name="Remesh")
+    remesh_modifier.mode = mode
+    remesh_modifier.octree_depth = depth
+    mesh = ob.to_mesh(scene, True, "PREVIEW")
+    scene.objects.unlink(ob)
+    bpy.data.objects.remove(ob)
+    bpy.data.meshes.remove(source)
+    return mesh
+
+
+def legacy_optimize(bm, iterations):
+    # The old per face optimize pass of OptimizedRemesh, kept here as the reference for the timings.
+    for _ in range(iterations):
+        merge_verts = set()
+        for face in bm.faces:
+            verts = [loop.vert for loop in face.loops]
+            link_counts = [len(vert.link_edges) for vert in verts]
+            if link_counts.count(3) > 1:
+                if link_counts[0] == 3 and link_counts[2] == 3:
+                    verts[0].co += verts[2].co
+                    verts[0].co /= 2
+                    verts[2].co = verts[0].co
+                    merge_verts.add(verts[0])
+                    merge_verts.add(verts[2])
+                elif link_counts[1] == 3 and link_counts[3] == 3:
+                    verts[1].co += verts[3].co
+                    verts[1].co /= 2
+                    verts[3].co = verts[1].co
+                    merge_verts.add(verts[1])
+                    merge_verts.add(verts[3])
+        bmesh.ops.remove_doubles(bm, verts=list(merge_verts), dist=0)
+    return bm
+
+
+def same_mesh(bm, co, loops, loop_totals, tolerance=1e-5):
+    # Whether a bmesh and mesh arrays have the same vertices within tolerance and faces over the same
+    # vertices, whatever their order. Every bmesh vertex is matched to the nearest array vertex.
+    if len(bm.verts) != len(co) or len(bm.faces) != len(loop_totals):
+        return False
+    tree = kdtree.KDTree(len(co))
+    for i, point in enumerate(np.asarray(co, dtype=np.float64).tolist()):
+        tree.insert(point, i)
+    tree.balance()
+
+    bm.verts.index_update()
+    match = [0] * len(co)
+    for vert in bm.verts:
+        point, index, distance = tree.find(vert.co)
+        if distance > tolerance:
+            return False
+        match[vert.index] = index
+    if len(set(match)) != len(co):
+        return False
+
+    legacy_faces = sorted(tuple(sorted(match[vert.index] for vert in face.verts)) for face in bm.faces)
+    faces = sorted(tuple(sorted(face.tolist())) for face in np.split(loops, np.cumsum(loop_totals)[:-1]))
+    return legacy_faces == faces
+
+
+def bench_optimize(depths=(5, 6, 7, 8, 9), iterations=6):
+    results = []
+    for depth in depths:
+        mesh = remeshed_mesh(depth)
+
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        legacy_time = timed(legacy_optimize, bm, iterations)[0]
+
+        arrays = mesh_to_arrays(mesh)
+        array_time, (co, loops, loop_totals) = timed(kernel.optimize_topology, *arrays, iterations)
+
+        results.append({"depth": depth,
+                        "faces": len(mesh.polygons),
+                        "legacy": legacy_time,
+                        "arrays": array_time,
+                        "speedup": legacy_time / array_time,
+                        "same_result": same_mesh(bm, co, loops, loop_totals)})
+        bm.free()
+        bpy.data.meshes.remove(mesh)
+    return results
+
+
+def nonmanifold_edges(loops, loop_totals):
+    edges, uses = np.unique(face_edges(loops, loop_totals), axis=0, return_counts=True)
+    return int((uses > 2).sum())
+
+
+def bench_voxel_remesh(depths=(5, 6, 7, 8), mode="SMOOTH"):
+    # The remesh modifier against the sparse voxel engine with the same cells, on a closed source.
+    results = []
+    for depth in depths:
+        modifier_time, mesh = timed(remeshed_mesh, depth, mode, closed=True)
+        modifier_arrays = mesh_to_arrays(mesh)
+        bpy.data.meshes.remove(mesh)
+
+        source = source_mesh(closed=True)
+        co, loops, loop_totals = mesh_to_arrays(source)
+        bpy.data.meshes.remove(source)
+        cell_size = (co.max(axis=0) - co.min(axis=0)).max() / 0.9 / 2 ** depth
+        voxel_time, voxel_arrays = timed(voxel_remesh.remesh, co, loops, loop_totals, cell_size)
+
+        results.append({"depth": depth,
+                        "modifier": modifier_time,
+                        "voxels": voxel_time,
+                        "modifier_faces": len(modifier_arrays[2]),
+                        "voxel_faces": len(voxel_arrays[2]),
+                        "modifier_nonmanifold": nonmanifold_edges(*modifier_arrays[1:]),
+                        "voxel_nonmanifold": nonmanifold_edges(*voxel_arrays[1:])})
+    return results
+
+
+def bench_field_queries(counts=(1000, 10000, 100000), single_limit=10000, seed=0):
+    # Queries per second of the field sampler, one point per call against whole batches.
+    source = source_mesh(closed=True)
+    ob = bpy.data.objects.new("bench_source", source)
+    sampler = flowretopo.FieldSampler(ob)
+    co = mesh_to_arrays(source)[0]
+    rng = np.random.RandomState(seed)
+    results = []
+    for count in counts:
+        points = rng.uniform(co.min(axis=0), co.max(axis=0), size=(count, 3))
+        single_count = min(count, single_limit)
+        single_time = timed(lambda: [sampler.sample_by_proximity(point) for point in points[:single_count]])[0]
+        batch_time = timed(sampler.sample_points, points)[0]
+        results.append({"points": count,
+                        "single_per_second": single_count / single_time,
+                        "batch_per_second": count / batch_time})
+    bpy.data.objects.remove(ob)
+    bpy.data.meshes.remove(source)
+    return results
+
+
+def report(name, results):
+    print(name)
+    for result in results:
+        print("  " + "  ".join("%s: %s" % (key, round(value, 4) if isinstance(value, float) else value)
+                               for key, value in result.items()))
+
+
+def run():
+    report("bones_to_mesh", bench_bones_to_mesh())
+    report("polygonize", bench_polygonize())
+    report("optimize_topology", bench_optimize())
+    report("voxel_remesh", bench_voxel_remesh())
+    report("field_queries", bench_field_queries())
@@ -1,5 +1,164 @@
+import time
+from collections import OrderedDict
 import bpy
-import bmesh
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+from .mesh_arrays import mesh_to_arrays, arrays_to_mesh, replace_mesh
+from .kernel import union_find
+
+
+def world_bounds(objects):
+    # (n, 2, 3) lowest and highest corners of the world space bounding boxes of the objects.
+    corners = np.array([[tuple(corner) for corner in ob.bound_box] for ob in objects], dtype=np.float64)
+    matrices = np.array([np.array(ob.matrix_world) for ob in objects])
+    world = np.einsum("nij,nkj->nki", matrices[:, :3, :3], corners) + matrices[:, None, :3, 3]
+    return np.stack((world.min(axis=1), world.max(axis=1)), axis=1)
+
+
+def boxes_overlap(bounds):
+    # (n, n) table of the pairs of bounds that touch.
+    lowest, highest = bounds[:, 0], bounds[:, 1]
+    return ((lowest[:, None] <= highest[None]) & (lowest[None] <= highest[:, None])).all(axis=2)
+
+
+def world_tree(ob):
+    # Tree over the faces of the object mesh in world space, and its vertices.
+    co, loops, loop_totals = mesh_to_arrays(ob.data)
+    matrix = np.array(ob.matrix_world)
+    co = co.dot(matrix[:3, :3].T) + matrix[:3, 3]
+    polygons = np.split(loops, (np.cumsum(loop_totals) - loop_totals)[1:])
+    return BVHTree.FromPolygons(co.tolist(), [polygon.tolist() for polygon in polygons]), co
+
+
+def inside(tree, point):
+    location, normal, index, distance = tree.find_nearest(point)
+    return location is not None and (Vector(point) - location).dot(normal) < 0
+
+
+def solids_overlap(a, b):
+    # Whether the closed meshes of two world trees share some volume: their surfaces cross,
+    # or one of them is entirely inside the other.
+    (tree_a, co_a), (tree_b, co_b) = a, b
+    if tree_a.overlap(tree_b):
+        return True
+    return (len(co_b) and inside(tree_a, co_b[0].tolist())) or (len(co_a) and inside(tree_b, co_a[0].tolist()))
+
+
+def working_copy(scene, ob):
+    # Copy of the object with its modifiers applied, linked so booleans can evaluate it.
+    copy = ob.copy()
+    copy.data = ob.to_mesh(scene, True, "PREVIEW")
+    copy.modifiers.clear()
+    scene.objects.link(copy)
+    return copy
+
+
+def apply_boolean(scene, ob, other, operation):
+    modifier = ob.modifiers.new(name="bollad", type="BOOLEAN")
+    modifier.object = other
+    modifier.operation = operation
+    mesh = ob.to_mesh(scene, True, "PREVIEW")
+    ob.modifiers.remove(modifier)
+    replace_mesh(ob, mesh)
+
+
+def reduce_booleans(scene, objects, operation):
+    # Combines the objects pairwise, level by level, so every part goes through a logarithmic number
+    # of booleans instead of growing one result operand after operand. The result is left in the first one.
+    objects = list(objects)
+    while len(objects) > 1:
+        for a, b in zip(objects[::2], objects[1::2]):
+            apply_boolean(scene, a, b, operation)
+        objects = objects[::2]
+        scene.update()
+    return objects[0]
+
+
+def resample(points, spacing):
+    # Points every spacing along the polyline, its ends included.
+    lengths = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+    if lengths[-1] <= spacing:
+        return points[[0, -1]]
+    stations = np.append(np.arange(0, lengths[-1], spacing), lengths[-1])
+    return np.stack([np.interp(stations, lengths, points[:, axis]) for axis in range(3)], axis=1)
+
+
+def simplify(points, tolerance):
+    # Ramer-Douglas-Peucker: the points needed to stay within tolerance of the polyline.
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        axis = b - a
+        length = np.linalg.norm(axis)
+        offsets = points[first + 1:last] - a
+        if length > 0:
+            distances = np.linalg.norm(np.cross(offsets, axis / length), axis=1)
+        else:
+            distances = np.linalg.norm(offsets, axis=1)
+        farthest = distances.argmax()
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            spans.append((first, middle))
+            spans.append((middle, last))
+    return points[keep]
+
+
+def cutter_arrays(strokes, view, thickness, depth):
+    # A thin wall along every stroke polyline, thickness wide and going depth to both sides along
+    # the view direction, as (co, loops, loop_totals) of closed solids facing outward.
+    co, loops, loop_totals = [], [], []
+    offset = 0
+    for points in strokes:
+        tangents = np.gradient(points, axis=0)
+        sides = np.cross(tangents, view)
+        sides /= np.maximum(np.linalg.norm(sides, axis=1), 1e-12)[:, None]
+        sides *= thickness / 2
+        front, back = view * -depth, view * depth
+        rings = np.stack((points - sides + front, points + sides + front,
+                          points + sides + back, points - sides + back), axis=1)
+        co.append(rings.reshape(-1, 3))
+
+        ring = 4 * np.arange(len(points) - 1)[:, None]
+        corner = np.arange(4)
+        following = (corner + 1) % 4
+        walls = np.stack((ring + corner, ring + following, ring + 4 + following, ring + 4 + corner), axis=2)
+        caps = np.array([[3, 2, 1, 0], [0, 1, 2, 3]]) + [[0], [4 * (len(points) - 1)]]
+        faces = np.concatenate((walls.reshape(-1, 4), caps)) + offset
+        loops.append(faces.ravel())
+        loop_totals.append(np.full(len(faces), 4))
+        offset += 4 * len(points)
+
+    co, loops, loop_totals = np.concatenate(co), np.concatenate(loops), np.concatenate(loop_totals)
+    # The winding depends on the side the strokes turn, the signed volume tells which way it went.
+    quads = co[loops.reshape(-1, 4)]
+    volume = sum((quads[:, 0] * np.cross(quads[:, corner], quads[:, corner + 1])).sum() for corner in (1, 2))
+    if volume < 0:
+        loops = loops.reshape(-1, 4)[:, ::-1].ravel()
+    return co, loops, loop_totals
+
+
+def join_meshes(ob, others):
+    # Appends the meshes of the other objects to the one of ob, in its local space.
+    co, loops, loop_totals = mesh_to_arrays(ob.data)
+    parts = [(co, loops, loop_totals)]
+    offset = len(co)
+    to_local = np.array(ob.matrix_world.inverted())
+    for other in others:
+        other_co, other_loops, other_loop_totals = mesh_to_arrays(other.data)
+        matrix = to_local.dot(np.array(other.matrix_world))
+        parts.append((other_co.dot(matrix[:3, :3].T) + matrix[:3, 3], other_loops + offset, other_loop_totals))
+        offset += len(other_co)
+    mesh = bpy.data.meshes.new(ob.data.name)
+    arrays_to_mesh(mesh, *[np.concatenate(arrays) for arrays in zip(*parts)])
+    replace_mesh(ob, mesh)
+
 
 class BoolKnife(bpy.types.Operator):
     bl_idname = "flol_tools.boolean_knife"
@@ -7,28 +166,64 @@ class BoolKnife(bpy.types.Operator):
     bl_description = ""
     bl_options = {"REGISTER", "UNDO"}
 
+    tolerance = bpy.props.FloatProperty(name="Tolerance", min=0.0001, default=0.01,
+                                        description="World distance the cut may stray from the strokes")
+    thickness = bpy.props.FloatProperty(name="Thickness", min=0.0001, default=0.005)
+
     @classmethod
     def poll(cls, context):
-        return True
+        if context.active_object:
+            return context.active_object.type == "MESH"
 
     def execute(self, context):
+        scene = context.scene
         ob = context.active_object
         gp = context.active_gpencil_layer
-        print(gp)
-        if gp:
-            strokes = gp.active_frame.strokes
-            if len(strokes) > 0:
-                bm = bmesh.new()
-                last_point = None
-                for point in strokes[0].points:
-                    point = bm.verts.new(point.co)
-                    if last_point:
-                        bm.edges.new(last_point, point)
-                        last_point = point
+        if not gp or not gp.active_frame or not len(gp.active_frame.strokes):
+            self.report({"WARNING"}, "No grease pencil strokes to cut with")
+            return {"CANCELLED"}
+
+        strokes = gp.active_frame.strokes
+        paths = []
+        used = []
+        point_count = 0
+        for stroke in strokes:
+            points = np.empty(len(stroke.points) * 3, dtype=np.float32)
+            stroke.points.foreach_get("co", points)
+            points = points.reshape(-1, 3).astype(np.float64)
+            point_count += len(points)
+            path = simplify(resample(points, self.tolerance), self.tolerance) if len(points) > 1 else points
+            if len(path) > 1:
+                paths.append(path)
+                used.append(stroke)
+        if not paths:
+            return {"CANCELLED"}
+
+        rv3d = context.region_data
+        view = rv3d.view_rotation * Vector((0, 0, -1)) if rv3d else Vector((0, 0, -1))
+        # Deep enough to go through the whole object from wherever the strokes were drawn.
+        lowest, highest = world_bounds([ob])[0]
+        center = (lowest + highest) / 2
+        depth = np.linalg.norm(highest - lowest) + max(np.linalg.norm(path - center, axis=1).max() for path in paths)
 
+        mesh = bpy.data.meshes.new("knife_cutter")
+        arrays_to_mesh(mesh, *cutter_arrays(paths, np.array(view), self.thickness, depth))
+        cutter = bpy.data.objects.new("knife_cutter", mesh)
+        scene.objects.link(cutter)
+        scene.update()
 
+        apply_boolean(scene, ob, cutter, "DIFFERENCE")
+        bpy.data.objects.remove(cutter)
+        bpy.data.meshes.remove(mesh)
+        # Strokes too short to cut with are left for the user.
+        for stroke in used:
+            strokes.remove(stroke)
+
+        self.report({"INFO"}, "Cut %d strokes, %d points as %d segments" % (
+            len(paths), point_count, sum(len(path) - 1 for path in paths)))
         return {"FINISHED"}
 
+
 class Booleans(bpy.types.Operator):
     bl_idname = "flow_tools.booleans"
     bl_label = ""
@@ -51,17 +246,62 @@ class Booleans(bpy.types.Operator):
                    context.active_object.type == "MESH"
 
     def execute(self, context):
+        scene = context.scene
         ob = context.active_object
         bpy.ops.object.convert(target="MESH")
-        delete = []
-        for ob2 in context.selected_objects:
-            if ob2.type == "MESH" and ob2 != ob:
-                bool = ob.modifiers.new(name="bollad", type="BOOLEAN")
-                bool.object = ob2
-                bool.operation = self.type
-                delete.append(ob2)
+        delete = [ob2 for ob2 in context.selected_objects if ob2.type == "MESH" and ob2 != ob]
+        timings = OrderedDict()
 
-        bpy.ops.object.convert(target="MESH")
+        start = time.perf_counter()
+        objects = [ob] + [working_copy(scene, ob2) for ob2 in delete]
+        scene.update()
+        timings["evaluation"] = time.perf_counter() - start
+
+        # Bounding boxes first, trees only for the pairs whose boxes touch.
+        start = time.perf_counter()
+        touching = boxes_overlap(world_bounds(objects))
+        if self.type != "UNION":
+            touching[1:] = False
+        timings["bounds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        trees = {}
+        pairs = []
+        for i, j in zip(*np.nonzero(np.triu(touching, 1))):
+            for index in (i, j):
+                if index not in trees:
+                    trees[index] = world_tree(objects[index])
+            if solids_overlap(trees[i], trees[j]):
+                pairs.append((i, j))
+        timings["overlap"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if self.type == "UNION":
+            # Operands of separate clusters don't interact, each cluster is reduced on its own
+            # and the results are only joined. Lone operands skip the booleans entirely.
+            clusters = union_find(len(objects), np.array(pairs, dtype=np.int64).reshape(-1, 2))
+            groups = OrderedDict()
+            for index, cluster in enumerate(clusters.tolist()):
+                groups.setdefault(cluster, []).append(objects[index])
+            culled = sum(len(group) == 1 for group in list(groups.values())[1:])
+            results = [reduce_booleans(scene, group, "UNION") for group in groups.values()]
+            if len(results) > 1:
+                join_meshes(ob, results[1:])
+        else:
+            # The target minus or intersected with all of them, the same as with their union or intersection.
+            kept = [objects[j] for i, j in pairs]
+            culled = len(delete) - len(kept)
+            if self.type == "INTERSECT" and culled:
+                replace_mesh(ob, bpy.data.meshes.new(ob.data.name))
+            elif kept:
+                other = reduce_booleans(scene, kept, "UNION" if self.type == "DIFFERENCE" else "INTERSECT")
+                apply_boolean(scene, ob, other, self.type)
+        timings["booleans"] = time.perf_counter() - start
+
+        for work in objects[1:]:
+            dt = work.data
+            bpy.data.objects.remove(work)
+            bpy.data.meshes.remove(dt)
 
         if self.remove_original:
             for ob in delete:
@@ -69,4 +309,6 @@ class Booleans(bpy.types.Operator):
                 bpy.data.meshes.remove(dt)
                 bpy.data.objects.remove(ob)
 
+        self.report({"INFO"}, "Culled %d of %d operands (%s)" % (
+            culled, len(delete), ", ".join("%s %.3f s" % (stage, seconds) for stage, seconds in timings.items())))
         return {"FINISHED"}
@@ -1,7 +1,60 @@
 import bpy
-import bmesh
 import mathutils
+import numpy as np
 from math import sqrt
+from .kernel import weighted_center, falloff_deform
+from .profiling import profiler
+
+
+def mask_weights(mesh):
+    # 1 - sculpt mask of every vertex, all ones when the mesh has no mask.
+    masks = np.zeros(len(mesh.vertices), dtype=np.float32)
+    if len(mesh.vertex_paint_masks):
+        mesh.vertex_paint_masks[0].data.foreach_get("value", masks)
+    return 1 - masks.astype(np.float64)
+
+
+def fill_vertex_group(vg, weights):
+    # One add call per distinct non zero weight.
+    values, groups = np.unique(weights, return_inverse=True)
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(len(values) + 1))
+    for value, start, stop in zip(values.tolist(), bounds[:-1], bounds[1:]):
+        if value != 0:
+            vg.add(order[start:stop].tolist(), value, "REPLACE")
+
+
+class FalloffDeformer:
+    # Moves the vertices of a mesh by the transform the handle made since the start, times their weight,
+    # like a hook modifier with no falloff. Rest positions and weights are taken once, only the vertices
+    # of non zero weight are computed and everything is written back with one foreach_set.
+    def __init__(self, mesh, co, weights, matrix, handle_matrix):
+        self.mesh = mesh
+        self.co = co.reshape(-1, 3).copy()
+        self.active = np.flatnonzero(weights)
+        self.rest = self.co[self.active].astype(np.float64)
+        self.weights = weights[self.active, None]
+        self.to_handle = handle_matrix.inverted() * matrix
+        self.to_local = matrix.inverted()
+        self.seen = handle_matrix.copy()
+
+    def follow(self, handle_matrix):
+        if handle_matrix == self.seen:
+            return
+        self.seen = handle_matrix.copy()
+        with profiler.span("deform update", vertices=len(self.active)):
+            deform = np.array(self.to_local * handle_matrix * self.to_handle)
+            self.co[self.active] = falloff_deform(self.rest, self.weights, deform)
+            self.write()
+        profiler.count("deform vertices written", len(self.co))
+
+    def restore(self):
+        self.co[self.active] = self.rest
+        self.write()
+
+    def write(self):
+        self.mesh.vertices.foreach_set("co", self.co.ravel())
+        self.mesh.update()
 
 
 class HandlerDeform(bpy.types.Operator):
@@ -10,11 +63,40 @@ class HandlerDeform(bpy.types.Operator):
     bl_description = ""
     bl_options = {"REGISTER", "UNDO"}
 
+    engine_items = (("DIRECT", "Direct", "Move the vertices from arrays while the handle moves"),
+                    ("HOOK", "Hook Modifier", "Hook the vertices to the handle and apply the modifier"))
+
+    engine = bpy.props.EnumProperty(items=engine_items, name="Engine", default="DIRECT")
+
     @classmethod
     def poll(cls, context):
         return True
 
+    def update_handler(self, scene):
+        self.deformer.follow(self.handle.matrix_world)
+
+    def finish_direct(self, context, confirm):
+        bpy.app.handlers.scene_update_pre.remove(self.update_handler)
+        if confirm:
+            self.deformer.follow(self.handle.matrix_world)
+        else:
+            self.deformer.restore()
+        context.scene.objects.unlink(self.handle)
+        bpy.data.objects.remove(self.handle)
+        context.scene.objects.active = self.ob
+        self.ob.select = True
+        bpy.ops.object.mode_set(mode=self.last_mode)
+
     def modal(self, context, event):
+        if self.engine == "DIRECT":
+            if event.type == "RET":
+                self.finish_direct(context, True)
+                return {"FINISHED"}
+            if event.type == "ESC":
+                self.finish_direct(context, False)
+                return {"CANCELLED"}
+            return {"PASS_THROUGH"}
+
         if event.type == "RET":
             context.scene.objects.active = self.ob
             enpty = self.hook.object
@@ -40,7 +122,6 @@ class HandlerDeform(bpy.types.Operator):
         return {"PASS_THROUGH"}
 
 
-
     def execute(self, context):
         ob = context.active_object
         sculpt_mode = False
@@ -50,27 +131,21 @@ class HandlerDeform(bpy.types.Operator):
 
         if ob.mode == "SCULPT":
             sculpt_mode = True
-            if context.sculpt_object.use_dynamic_topology_sculpting:
+            if self.engine == "DIRECT":
+                # Leaving sculpt mode writes the sculpt, dynamic topology included, to the mesh and keeps
+                # the undo history, the mode comes back on confirm.
+                bpy.ops.object.mode_set(mode="OBJECT")
+            elif context.sculpt_object.use_dynamic_topology_sculpting:
                 was_dyntopo = True
                 bpy.ops.sculpt.dynamic_topology_toggle()
 
-        bm = bmesh.new()
-        bm.verts.ensure_lookup_table()
-        bm.from_mesh(ob.data)
-
-        mask = bm.verts.layers.paint_mask.verify()
-        vg = ob.vertex_groups.new("sculpt_mask_vertex_group")
-
-        center = mathutils.Vector()
-        average_normalizer = 0
-
-        for vert in bm.verts:
-            weight = 1 - vert[mask]
-            center += (vert.co * ob.matrix_world) * weight
-            average_normalizer += weight
-            vg.add([vert.index], weight, "REPLACE")
-
-        center /= average_normalizer
+        mesh = ob.data
+        with profiler.span("deform setup", vertices=len(mesh.vertices)):
+            co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+            mesh.vertices.foreach_get("co", co)
+            weights = mask_weights(mesh)
+            center, average_normalizer = weighted_center(co.reshape(-1, 3), weights, ob.matrix_world)
+        center = mathutils.Vector(center) / average_normalizer
         radius = 1
         gp = context.active_gpencil_layer
 
@@ -92,6 +167,20 @@ class HandlerDeform(bpy.types.Operator):
         bpy.ops.object.mode_set(mode="OBJECT")
         bpy.ops.object.empty_add(type="PLAIN_AXES", location=center, radius=radius)
 
+        self.ob = ob
+        self.last_mode = last_mode
+        wm = context.window_manager
+
+        if self.engine == "DIRECT":
+            self.handle = context.active_object
+            self.deformer = FalloffDeformer(mesh, co, weights, ob.matrix_world, self.handle.matrix_world)
+            bpy.app.handlers.scene_update_pre.append(self.update_handler)
+            ob.select = False
+            wm.modal_handler_add(self)
+            return {"RUNNING_MODAL"}
+
+        vg = ob.vertex_groups.new("sculpt_mask_vertex_group")
+        fill_vertex_group(vg, weights)
         hook = ob.modifiers.new("handler", "HOOK")
         hook.object = context.active_object
         hook.vertex_group = vg.name
@@ -104,16 +193,13 @@ class HandlerDeform(bpy.types.Operator):
         context.scene.objects.active = hook.object
         ob.select = False
 
-        self.ob = ob
         self.hook = hook
-        self.last_mode = last_mode
         self.vg = vg
         self.was_dyntopo = was_dyntopo
 
-        wm = context.window_manager
         wm.modal_handler_add(self)
         return {"RUNNING_MODAL"}
 
     def cancel(self, context):
-        wm= context.window_manager
-        wm.event_timer_remove(self._timer)
+        if self.engine == "DIRECT" and self.update_handler in bpy.app.handlers.scene_update_pre:
+            bpy.app.handlers.scene_update_pre.remove(self.update_handler)
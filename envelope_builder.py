@@ -3,80 +3,242 @@
 
 # The basic idea is to take advantage of the envelope data in an armature and convert it in to a mesh
 import os
-import bmesh
-import mathutils
-import math
+import time
+import numpy as np
 import bpy
+from . import implicit
+from .profiling import profiler
+from .mesh_arrays import mesh_to_arrays, arrays_to_mesh, replace_mesh
+from .kernel import (ProfileLibrary, bone_arrays, armature_size, bone_steps, element_placement, mirror_plan,
+                     slice_index)
 
 
-# A simple linear interpolation function
-# This is needed for interpolate the radius of the envelope bones
-# while adding metabals.
-def flerp(a, b, c):
-    return a * c + (1 - c) * b
-
-
-class BoneProfile:
-    def __init__(self):
+class BoneProfile(ProfileLibrary):
+    # The profile library of the addon, the base level is only read when first needed,
+    # from an array cache kept next to the .blend file.
+    def __init__(self, name="icosphere", mesh_name="Icosphere"):
         rn = os.path.realpath(os.path.dirname(__file__))
-        path = os.path.join(rn, "bone_profiles", "icosphere.blend")
-        with bpy.types.BlendDataLibraries.load(path) as (data_from, data_to):
-            data_to.meshes.append("Icosphere")
-
-        self.profiles = {}
-
-        for mesh in data_to.meshes:
-            if mesh is None:
-                continue
-            bm = bmesh.new()
-            bm.from_mesh(mesh)
-
-            self.__bm = bm
-            self.saved_data_to = data_to
-
-    def bone_to_mesh(self, bone, step_size, min_steps, to_bm, type=None):
+        self.path = os.path.join(rn, "bone_profiles", name + ".blend")
+        self.mesh_name = mesh_name
+        ProfileLibrary.__init__(self, load_base=lambda: load_profile(self.path, self.mesh_name))
+
+    def bones_to_mesh(self, bones, step_size, min_steps, mesh, local=False, quality=2, adaptive=True):
+        # Builds the rings of all bones at once and writes them in bulk into an empty mesh.
+        arrays_to_mesh(mesh, *self.bones_to_arrays(bones, step_size, min_steps, local, quality, adaptive))
+        return mesh
+
+
+def load_profile(path, mesh_name):
+    # Reads the profile arrays from the .npz cache, only falling back to the library loader
+    # when the cache is missing or older than the .blend file.
+    cache = os.path.splitext(path)[0] + ".npz"
+    mtime = os.path.getmtime(path)
+    try:
+        with np.load(cache) as data:
+            if data["mtime"] == mtime and data["mesh_name"] == mesh_name:
+                return data["co"], data["loops"], data["loop_totals"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    with bpy.data.libraries.load(path) as (data_from, data_to):
+        data_to.meshes = [mesh_name]
+    mesh = data_to.meshes[0]
+    arrays = mesh_to_arrays(mesh)
+    bpy.data.meshes.remove(mesh)
+
+    co, loops, loop_totals = arrays
+    try:
+        np.savez(cache, mtime=mtime, mesh_name=mesh_name, co=co, loops=loops, loop_totals=loop_totals)
+    except OSError:
+        # Read only installs just reload from the .blend next session.
+        pass
+    return arrays
+
+
+class EnvelopePreview:
+    # Keeps the preview mesh of one armature in sync with its bones.
+    # Every bone is keyed by its head, tail, radii (with the parent radius resolved) and the step parameters,
+    # only bones whose key changed get their rings rebuilt, and the mesh is not touched when nothing changed.
+    def __init__(self, profile):
+        self.profile = profile
+        self.key = None
+        self.params = None
+        self.steps = None
+        self.slices = None
+        self.co = None
+        self.vertex_count = 0
+
+    def snapshot(self, armature, step_size, min_steps, quality):
+        # With X mirror on, only one side of the symmetric bones is generated, the key then
+        # also holds the mirror plan so a change of symmetry forces a rebuild.
+        # The level of detail of each bone goes in the last column of the params.
+        bones = list(armature.edit_bones)
+        names = [bone.name for bone in bones]
+        params = np.column_stack(bone_arrays(bones))
+        levels = self.profile.choose_levels(np.maximum(params[:, 6], params[:, 7]), armature_size(params), quality)
+        params = np.column_stack((params, levels))
+        plan = None
+        if armature.use_mirror_x:
+            sources, mirrored = mirror_plan(names, params[:, :8])[:2]
+            params = params[sources]
+            plan = (tuple(sources.tolist()), tuple(mirrored.tolist()))
+        key = (armature.name, names, (step_size, min_steps), plan)
+        return key, params
+
+    def job(self, ob, key, params):
+        # Returns the work needed to bring the mesh up to date, or None if it already is.
+        if key != self.key or self.co is None or len(ob.data.vertices) != self.vertex_count:
+            return PreviewJob(self, key, params, np.arange(len(params)), full=True)
+
+        dirty = np.flatnonzero((params != self.params).any(axis=1))
+        if not len(dirty):
+            return None
+
+        if (bone_steps(params[dirty, :3], params[dirty, 3:6], *key[2]) != self.steps[dirty]).any() \
+                or (params[dirty, 8] != self.params[dirty, 8]).any():
+            # The vertex count of some bone changed, patching is not possible.
+            return PreviewJob(self, key, params, np.arange(len(params)), full=True)
+
+        return PreviewJob(self, key, params, dirty, full=False)
+
+    def update(self, armature, ob, step_size, min_steps, quality=1):
+        # Synchronous update, returns True if the mesh was written.
+        job = self.job(ob, *self.snapshot(armature, step_size, min_steps, quality))
+        if job is None:
+            return False
+        job.run()
+        job.finish(ob)
+        return True
 
-        bm = self.__bm
 
-        if bone.parent:
-            head_radius = bone.parent.tail_radius
+class PreviewJob:
+    # Generates the rings of a set of bones in chunks, so a large rebuild can be spread over several ticks.
+    # The result only reaches the mesh (and the preview cache) in finish().
+    def __init__(self, preview, key, params, indices, full, chunk=8):
+        self.preview = preview
+        self.key = key
+        self.params = params
+        self.remaining = indices
+        self.full = full
+        self.chunk = chunk
+
+        self.steps = bone_steps(params[:, :3], params[:, 3:6], *key[2])
+        self.levels = params[:, 8].astype(np.int64)
+        sizes = (self.steps + 1) * preview.profile.vertex_counts(self.levels)
+        ends = np.cumsum(sizes)
+        self.slices = np.stack((ends - sizes, ends), axis=1)
+        self.mirrored = np.array(key[3][1] if key[3] else [], dtype=np.int64)
+        self.mirror_index = slice_index(self.slices[self.mirrored])
+        if full:
+            self.co = np.empty((ends[-1] if len(ends) else 0, 3), dtype=np.float32)
         else:
-            head_radius = bone.head_radius
-
-        tail_radius = bone.tail_radius
-        length = bone.length
-        head = bone.head
-        tail = bone.tail
-
-        steps = round(length / step_size)
-        if steps < min_steps:
-            steps = min_steps
-
-        for step in range(steps + 1):
-            new_verts = []
-
-            for vert in bm.verts:
-                co = vert.co
-                co *= flerp(head_radius, tail_radius, step / steps)
-                co += head.lerp(tail, step / steps)
-                new_verts.append(to_bm.verts.new(co))
-
-            for edge in bm.edges:
-                to_bm.edges.new([new_verts[vert.index] for vert in edge.verts])
-
-            for face in bm.faces:
-                to_bm.faces.new([new_verts[vert.index] for vert in face.verts])
-
-        return bm if not to_bm else to_bm
+            self.co = preview.co.copy()
+
+    @property
+    def done(self):
+        return not len(self.remaining)
+
+    def run(self, deadline=None):
+        # Works until everything is generated or the perf_counter deadline passes.
+        while len(self.remaining):
+            chunk, self.remaining = self.remaining[:self.chunk], self.remaining[self.chunk:]
+            with profiler.span("preview rebuild slice", bones=len(chunk)):
+                self.co[slice_index(self.slices[chunk])] = self.preview.profile.ring_co(self.params[chunk],
+                                                                                        *self.key[2])
+
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+    def finish(self, ob):
+        with profiler.span("preview write", full=self.full):
+            self.write(ob)
+        profiler.count("preview vertices written", self.preview.vertex_count)
+
+    def write(self, ob):
+        profile = self.preview.profile
+        # The mirrored bones are appended as one mirrored copy of their generated vertices.
+        co = np.concatenate((self.co, self.co[self.mirror_index] * np.float32((-1, 1, 1))))
+        if self.full:
+            loops, loop_totals = profile.topology(self.steps, self.levels)
+            mirror_loops, mirror_loop_totals = profile.topology(self.steps[self.mirrored], self.levels[self.mirrored],
+                                                                flipped=True, offset=len(self.co))
+            mesh = bpy.data.meshes.new(ob.data.name)
+            arrays_to_mesh(mesh, co,
+                           np.concatenate((loops, mirror_loops)),
+                           np.concatenate((loop_totals, mirror_loop_totals)))
+            replace_mesh(ob, mesh)
+        else:
+            ob.data.vertices.foreach_set("co", co.ravel())
+            ob.data.update()
+
+        preview = self.preview
+        preview.key = self.key
+        preview.params = self.params
+        preview.steps = self.steps
+        preview.slices = self.slices
+        preview.co = self.co
+        preview.vertex_count = len(co)
+
+
+class PreviewScheduler:
+    # Runs the preview updates out of the critical path of the scene update handler.
+    # Edits are coalesced until the bones stayed still for idle_delay seconds, then the rebuild
+    # runs in slices of at most budget seconds per tick.
+    def __init__(self, preview):
+        self.preview = preview
+        self.job = None
+        self.seen = None
+        self.last_change = 0.0
+        self.pending_changes = 0
+        self.work_time = 0.0
+
+        # Statistics, useful to tune idle_delay and budget on heavy rigs.
+        self.last_rebuild_time = 0.0
+        self.last_rebuild_ticks = 0
+        self.rebuilds = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def tick(self, armature, ob, step_size, min_steps, quality, idle_delay, budget):
+        now = time.perf_counter()
+        key, params = self.preview.snapshot(armature, step_size, min_steps, quality)
+
+        if self.seen is None or key != self.seen[0] or not np.array_equal(params, self.seen[1]):
+            # Something moved, whatever was in progress is stale.
+            self.seen = key, params
+            self.last_change = now
+            self.pending_changes += 1
+            self.job = None
+            return
+
+        if self.job is None:
+            if not self.pending_changes or now - self.last_change < idle_delay:
+                return
+            self.job = self.preview.job(ob, key, params)
+            if self.job is None:
+                # The bones came back to the state already on the mesh.
+                self.skipped += self.pending_changes
+                self.pending_changes = 0
+                return
+            self.work_time = 0.0
+            self.last_rebuild_ticks = 0
+
+        self.job.run(now + budget)
+        self.last_rebuild_ticks += 1
+        if self.job.done:
+            self.job.finish(ob)
+            self.rebuilds += 1
+            self.coalesced += self.pending_changes - 1
+            self.pending_changes = 0
+            self.job = None
+        self.work_time += time.perf_counter() - now
+        if self.job is None:
+            self.last_rebuild_time = self.work_time
 
 
 profiles = BoneProfile()
-
-
-def del_loaded_profile_meshes(scene):
-    for mesh in profiles.saved_data_to.meshes:
-        bpy.data.meshes.remove(mesh)
-    bpy.app.handlers.scene_update_pre.remove(del_loaded_profile_meshes)
+preview = EnvelopePreview(profiles)
+scheduler = PreviewScheduler(preview)
 
 
 @bpy.app.handlers.persistent
@@ -90,10 +252,8 @@ def update_envelope_preview(scene):
     if ob.type == "ARMATURE":
         if ob.mode == "EDIT":
             if ob.data.custom_preview_envelope:
-                bm = bmesh.new()
-                for bone in ob.data.edit_bones:
-                    profiles.bone_to_mesh(bone, 0.05, 10, to_bm=bm)
-                bm.to_mesh(test_ob.data)
+                scheduler.tick(ob.data, test_ob, 0.05, 10, ob.data.custom_preview_quality,
+                               ob.data.custom_preview_idle_delay, ob.data.custom_preview_budget)
 
 
 class EnvelopeAdvancedPreview(bpy.types.Operator):
@@ -140,13 +300,20 @@ class EnvelopeToMetaball(bpy.types.Operator):
     bl_description = ""
     bl_options = {"REGISTER", "UNDO"}
 
+    spacing_items = (("FIXED", "Fixed", "Place elements every step size"),
+                     ("ADAPTIVE", "Adaptive", "Place elements every fraction of the bone radius"))
+
+    spacing = bpy.props.EnumProperty(items=spacing_items, name="Spacing", default="FIXED")
     step_size = bpy.props.FloatProperty(name="Step Size", default=0.05)  # The size of the steps betwen metabals
     min_steps = bpy.props.IntProperty(name="Minimun Steps", default=10)  # The minimun amount of steps per bone
+    radius_fraction = bpy.props.FloatProperty(name="Radius Fraction", min=0.01, default=0.5)  # Adaptive step size
     resolution = bpy.props.FloatProperty(name="Metabals Resolution", default=20.0)  # Resolution of final mesh
     radius_multiplier = bpy.props.FloatProperty(name="Radius Multiplier", default=1.0)
     metaball_stiffness = bpy.props.FloatProperty(name="Metabals Stifness", default=10)  # The metabal stifness
     theshold = bpy.props.FloatProperty(name="Metabals Threshold", default=0.01)  # Metabal Hardness
     remove_original = bpy.props.BoolProperty(name="Remove original", default=True)  # Optionaly delete original armature
+    use_mirror = bpy.props.BoolProperty(name="Mirror", default=True)  # Compute one side of symmetric bones
+    mirror_tolerance = bpy.props.FloatProperty(name="Mirror Tolerance", min=0, default=0.0001)
 
     @classmethod
     def poll(cls, context):
@@ -154,6 +321,41 @@ class EnvelopeToMetaball(bpy.types.Operator):
             # only enable This operator if an armature is elected
             return context.active_object.type in ["ARMATURE", "META"]
 
+    def placement(self, armature):
+        # Element positions and radii for every bone of the armature.
+        # The bones use the tail radius of its parent as head radius when there is one, bone_arrays handles that.
+        bones = armature.data.bones
+        params = np.column_stack(bone_arrays(bones, local=True))
+        fraction = self.radius_fraction if self.spacing == "ADAPTIVE" else None
+
+        mirrored = np.empty(0, dtype=np.int64)
+        if self.use_mirror:
+            # Symmetric bones are only placed on one side, the other side is a mirrored copy
+            sources, mirrored = mirror_plan([bone.name for bone in bones], params, self.mirror_tolerance)[:2]
+            params = params[sources]
+
+        co, radii, bone_index = element_placement(params[:, :3], params[:, 3:6], params[:, 6], params[:, 7],
+                                                  self.step_size, self.min_steps, fraction)
+        mirror = np.isin(bone_index, mirrored)
+        co = np.concatenate((co, co[mirror] * (-1, 1, 1)))
+        radii = np.concatenate((radii, radii[mirror]))
+        return co, radii
+
+    def invoke(self, context, event):
+        wm = context.window_manager
+        return wm.invoke_props_dialog(self)
+
+    def draw(self, context):
+        layout = self.layout
+        for prop in ("spacing", "step_size", "min_steps", "radius_fraction", "resolution",
+                     "radius_multiplier", "metaball_stiffness", "theshold", "remove_original",
+                     "use_mirror", "mirror_tolerance"):
+            layout.prop(self, prop)
+
+        # Let the user see how heavy the result is going to be before converting.
+        if context.active_object and context.active_object.type == "ARMATURE":
+            layout.label("Elements: %d" % len(self.placement(context.active_object)[1]))
+
     def execute(self, context):
 
         if not context.active_object.type == "ARMATURE":
@@ -169,44 +371,130 @@ class EnvelopeToMetaball(bpy.types.Operator):
         meta.data.threshold = self.theshold
         meta.data.resolution = 1 / self.resolution
 
-        for bone in armature.data.bones:  # So we start looping thought the bones
+        # Every element of every bone is placed at once
+        with profiler.span("metaball placement", bones=len(armature.data.bones)):
+            co, radii = self.placement(armature)
+
+        # The elements can only be created one by one, but all their properties are filled in bulk
+        with profiler.span("metaball elements"):
+            elements = meta.data.elements
+            for _ in range(len(radii)):
+                elements.new()
+            elements.foreach_set("co", co.astype(np.float32).ravel())
+            elements.foreach_set("radius", (radii * self.radius_multiplier).astype(np.float32))
+            elements.foreach_set("stiffness", np.full(len(radii), self.metaball_stiffness, dtype=np.float32))
+        profiler.count("elements", len(radii))
+
+        # If the user wants so, delete the original armature.
+        if self.remove_original:
+            context.scene.objects.unlink(armature)
+            bpy.data.armatures.remove(armature.data)
+            bpy.data.objects.remove(armature)
+
+        return {"FINISHED"}
+
+
+# Operator that meshes the envelope directly as a smooth union of tapered capsules
+class EnvelopeToMesh(bpy.types.Operator):
+    bl_idname = "flow_tools.envelope_mesh_convert"
+    bl_label = "Convert To Mesh (Implicit)"
+    bl_description = "Polygonize the envelope directly, without going through metaballs"
+    bl_options = {"REGISTER", "UNDO"}
+
+    voxel_size = bpy.props.FloatProperty(name="Voxel Size", min=0.001, default=0.02)  # Size of the grid cells
+    blend = bpy.props.FloatProperty(name="Blend", min=0, default=0.05)  # How far the bone surfaces melt together
+    radius_multiplier = bpy.props.FloatProperty(name="Radius Multiplier", default=1.0)
+    block_size = bpy.props.IntProperty(name="Block Size", min=4, default=24)  # Cells per side of a work block
+    threads = bpy.props.IntProperty(name="Threads", min=0, default=0, description="0 uses every core")
+    remove_original = bpy.props.BoolProperty(name="Remove original", default=True)  # Optionaly delete original armature
+    use_mirror = bpy.props.BoolProperty(name="Mirror", default=True)  # Polygonize one side of symmetric armatures
+    mirror_tolerance = bpy.props.FloatProperty(name="Mirror Tolerance", min=0, default=0.0001)
+
+    @classmethod
+    def poll(cls, context):
+        if context.active_object:
+            return context.active_object.type == "ARMATURE"
+
+    def execute(self, context):
+        armature = context.active_object
+        if armature.mode == "EDIT":
+            bpy.ops.object.mode_set(mode="OBJECT")
+
+        bones = armature.data.bones
+        heads, tails, head_radii, tail_radii = bone_arrays(bones, local=True)
+        field = implicit.CapsuleField(heads, tails,
+                                      head_radii * self.radius_multiplier,
+                                      tail_radii * self.radius_multiplier,
+                                      self.blend)
+
+        # Only mirror when every bone is either a centre bone or has a symmetric partner.
+        mirror = False
+        if self.use_mirror:
+            params = np.column_stack((heads, tails, head_radii, tail_radii))
+            paired, center = mirror_plan([bone.name for bone in bones], params, self.mirror_tolerance)[2:]
+            mirror = bool((paired | center).all())
+
+        co, faces = implicit.polygonize(field, self.voxel_size, self.block_size, self.threads, mirror)
+
+        mesh = bpy.data.meshes.new(armature.name + "_envelope")
+        arrays_to_mesh(mesh, co, faces.ravel(), np.full(len(faces), 3))
+        ob = bpy.data.objects.new(mesh.name, mesh)
+        ob.matrix_world = armature.matrix_world
+        context.scene.objects.link(ob)
 
-            length = bone.length  # This is the bone length
-            # Using the length we can find the number of metas we need to fill it acording to the step size
-            step_number = round(length / self.step_size)
-            if step_number < self.min_steps:
-                step_number = self.min_steps
+        if self.remove_original:
+            context.scene.objects.unlink(armature)
+            bpy.data.armatures.remove(armature.data)
+            bpy.data.objects.remove(armature)
 
-            # So we start looping thought the steps
-            for step in range(step_number + 1):
+        for other in context.selected_objects:
+            other.select = False
+        ob.select = True
+        context.scene.objects.active = ob
+        return {"FINISHED"}
 
-                # A simple interpolation resolves the next metaball position on the bone
-                loc = bone.head_local.lerp(bone.tail_local, step / step_number)
 
-                # We put an metaelement there
-                element = meta.data.elements.new()
-                element.co = loc
+# Operator that builds the final mesh from the bone profiles, the preview shape at the finest level of detail
+class EnvelopeToProfileMesh(bpy.types.Operator):
+    bl_idname = "flow_tools.envelope_profile_convert"
+    bl_label = "Convert To Mesh (Profiles)"
+    bl_description = "Build the rings of the bone profiles like the preview does, at a fine level of detail"
+    bl_options = {"REGISTER", "UNDO"}
 
-                # get the bone tail radius
-                r1 = bone.tail_radius
-                # An tricky part is to interpolate the bone head radius,
-                # since the bones actualy uses the tail radius of its parent when there is one
-                if bone.parent:
-                    r2 = bone.parent.tail_radius
-                else:
-                    r2 = bone.head_radius
+    step_size = bpy.props.FloatProperty(name="Step Size", min=0.001, default=0.05)  # Distance between rings
+    min_steps = bpy.props.IntProperty(name="Minimun Steps", min=1, default=10)  # The minimun amount of rings
+    quality = bpy.props.IntProperty(name="Quality", min=0, max=BoneProfile.max_level, default=BoneProfile.max_level,
+                                    description="Profile level of detail of the biggest bones")
+    adaptive = bpy.props.BoolProperty(name="Adaptive", default=True,
+                                      description="Smaller bones use coarser levels, like in the preview")
+    remove_original = bpy.props.BoolProperty(name="Remove original", default=True)  # Optionaly delete original armature
 
-                # Use the lerp function created previously to interpolate the radius of the bones
-                radius = flerp(r1, r2, step / step_number)
-                element.radius = radius * self.radius_multiplier  # Then we set the meta element tadius
+    @classmethod
+    def poll(cls, context):
+        if context.active_object:
+            return context.active_object.type == "ARMATURE"
 
-                # An final per-element property
-                element.stiffness = self.metaball_stiffness
+    def execute(self, context):
+        armature = context.active_object
+        if armature.mode == "EDIT":
+            bpy.ops.object.mode_set(mode="OBJECT")
+
+        with profiler.span("profile mesh", bones=len(armature.data.bones)):
+            mesh = profiles.bones_to_mesh(armature.data.bones, self.step_size, self.min_steps,
+                                          bpy.data.meshes.new(armature.name + "_envelope"), local=True,
+                                          quality=self.quality, adaptive=self.adaptive)
+        profiler.count("vertices written", len(mesh.vertices))
+        ob = bpy.data.objects.new(mesh.name, mesh)
+        ob.matrix_world = armature.matrix_world
+        context.scene.objects.link(ob)
 
-                # If the user wants so, delete the original armature.
         if self.remove_original:
             context.scene.objects.unlink(armature)
             bpy.data.armatures.remove(armature.data)
             bpy.data.objects.remove(armature)
 
+        for other in context.selected_objects:
+            other.select = False
+        ob.select = True
+        context.scene.objects.active = ob
         return {"FINISHED"}
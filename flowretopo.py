@@ -1,19 +1,40 @@
-import bmesh
+import time
+from collections import OrderedDict
 import bpy
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+from .mesh_arrays import arrays_to_mesh
+from .kernel import CurvatureField, quad_mesh
 
 
-class FieldSampler:
+class FieldSampler(CurvatureField):
     def __init__(self, object):
-        self.bm = bmesh.new()
-        self.bm.from_mesh(object.data)
         self.object = object
 
+        mesh = object.data
+        # Single precision like the mathutils vectors, so scores order the same.
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        vert_normals = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("normal", vert_normals)
+        face_normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+        mesh.polygons.foreach_get("normal", face_normals)
+        loops = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loops)
+        loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+        CurvatureField.__init__(self, co.reshape(-1, 3), vert_normals.reshape(-1, 3), face_normals.reshape(-1, 3),
+                                loops, loop_totals)
+
+        # One tree over the faces for proximity queries, kept for the sampler lifetime.
+        polygons = np.split(loops, self.loop_starts[1:])
+        self.tree = BVHTree.FromPolygons(self.co.tolist(), [polygon.tolist() for polygon in polygons])
+
     def sample_vert(self, vert, normalized=True, cross=False):
-        vecs = [face.normal - vert.normal for face in vert.link_faces]
+        bigest = Vector(self.field[vert.index])
         if normalized or cross:
-            bigest = sorted(vecs, key=lambda vec: vec.length_squared)[-1].normalized()
-        else:
-            bigest = sorted(vecs, key=lambda vec: vec.length_squared)[-1]
+            bigest = bigest.normalized()
         if cross:
             v1 = bigest
             v2 = bigest.cross(vert.normal)
@@ -21,49 +42,24 @@ class FieldSampler:
 
         return bigest
 
-    def choose_verts(self, n):
-        scores = []
-        for vert in self.bm.verts:
-            s = self.sample_vert(vert, normalized=False).length_squared
-            scores.append((vert, s))
-        scores = sorted(scores, key=lambda pair: pair[1])
-        return [pair[0] for pair in scores][-n:]
-
     def sample_by_proximity(self, co):
-        result, location, normal, face_index = self.object.closest_point_on_mesh(co)
-
-        v0 = self.sample_vert(self.bm.faces[face_index].verts[0])
-
-        for vert in self.bm.faces[face_index].verts[1]:
-            vs = self.sample_vert(vert, cross=True)
-            v0 += sorted(
-                [(v, v.dot(v0)) for v in vs],
-                key=lambda tuple: tuple[1]
-            )[-1]
-
-        return v0 / len(self.bm.faces[face_index].verts)
+        return Vector(self.sample_points([co])[0])
 
+    def sample_points(self, points):
+        # Field at the nearest surface point of each of the (n, 3) points.
+        faces = np.array([self.tree.find_nearest(point)[2] for point in np.asarray(points).tolist()], dtype=np.int64)
+        return self.face_directions(faces)
 
-def copy_mesh(object, copy_data=True):
-    cob = object.copy()
-    if copy_data:
-        cdt = object.data.copy()
-        cob.data = cdt
-    else:
-        ndt = bpy.data.meshes.new(name=object.data.name)
-        cob.data = ndt
-    bpy.context.scene.objects.link(cob)
 
-
-def test_field(object):
-    sampler = FieldSampler(object)
-    dt = bpy.data.meshes.new(name="test_mesh")
-    bm = sampler.bm
-    verts = sampler.choose_verts(1500)
-    for vert in verts:
-        vert.select = True
-
-    bm.to_mesh(object.data)
+def quad_retopo(sampler, target_faces, threads=0, max_sides=4, tolerance=1e-3, max_iterations=100):
+    # The kernel quad remesh of the sampler mesh, projected back on its surface.
+    # Returns (co, loops, loop_totals) and the seconds spent in every phase.
+    (co, loops, loop_totals), timings = quad_mesh(sampler, target_faces, threads, max_sides, tolerance,
+                                                  max_iterations)
+    start = time.perf_counter()
+    co = np.array([sampler.tree.find_nearest(point)[0] or point for point in co.tolist()], dtype=np.float64)
+    timings["extraction"] += time.perf_counter() - start
+    return (co.reshape(-1, 3), loops, loop_totals), timings
 
 
 class AutoRetopo(bpy.types.Operator):
@@ -72,10 +68,44 @@ class AutoRetopo(bpy.types.Operator):
     bl_description = ""
     bl_options = {"REGISTER"}
 
+    target_faces = bpy.props.IntProperty(name="Target Faces", default=2000, min=1)
+    max_sides = bpy.props.IntProperty(name="Max Face Sides", default=4, min=3, max=8,
+                                      description="Larger faces are left out, 4 for quads and triangles only")
+    threads = bpy.props.IntProperty(name="Threads", default=0, min=0, description="0 for one per cpu")
+    iterations = bpy.props.IntProperty(name="Max Iterations", default=100, min=1,
+                                       description="Position field sweeps per hierarchy level")
+
     @classmethod
     def poll(cls, context):
-        return True
+        if context.active_object:
+            return context.active_object.type in "MESH"
+
+    def invoke(self, context, event):
+        wm = context.window_manager
+        return wm.invoke_props_dialog(self)
 
     def execute(self, context):
-        test_field(context.active_object)
+        ob = context.active_object
+        timings = OrderedDict()
+        start = time.perf_counter()
+        sampler = FieldSampler(ob)
+        timings["sampling"] = time.perf_counter() - start
+
+        (co, loops, loop_totals), phases = quad_retopo(sampler, self.target_faces, self.threads, self.max_sides,
+                                                       max_iterations=self.iterations)
+        timings.update(phases)
+
+        start = time.perf_counter()
+        mesh = arrays_to_mesh(bpy.data.meshes.new(name=ob.data.name + "_retopo"), co, loops, loop_totals)
+        n_ob = bpy.data.objects.new(ob.name + "_retopo", mesh)
+        n_ob.matrix_world = ob.matrix_world
+        context.scene.objects.link(n_ob)
+        ob.select = False
+        n_ob.select = True
+        context.scene.objects.active = n_ob
+        timings["output"] = time.perf_counter() - start
+
+        self.report({"INFO"}, "%d faces in %.2f s (%s)" % (
+            len(loop_totals), sum(timings.values()),
+            ", ".join("%s %.2f" % (phase, seconds) for phase, seconds in timings.items())))
         return {"FINISHED"}
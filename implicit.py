@@ -0,0 +1,218 @@
+# Implicit surface meshing of envelope armatures.
+# Every bone becomes a tapered capsule, the capsules are blended with a smooth minimum
+# and the resulting distance field is polygonized directly, without going through metaballs.
+# Only blocks of the grid near the surface are ever evaluated, so memory follows the surface area.
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Corners of a cube, indexed by bits: x = 1, y = 2, z = 4.
+CORNERS = np.array([[(i >> 0) & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+
+# Six tetrahedra sharing the 0-7 diagonal. Neighbour cubes split their shared faces
+# along the same diagonals, so the surface comes out watertight.
+TETRAHEDRA = np.array([[0, a, a + b, 7] for a, b in ((1, 2), (1, 4), (2, 1), (2, 4), (4, 1), (4, 2))])
+
+
+def _tetrahedron_table():
+    # For each of the 16 inside/outside cases of a tetrahedron, up to two triangles,
+    # every triangle vertex given as the (inside, outside) corner pair of the edge it lies on.
+    table = np.full((16, 2, 3, 2), -1)
+    for case in range(16):
+        inside = [i for i in range(4) if case >> i & 1]
+        outside = [i for i in range(4) if not case >> i & 1]
+        if len(inside) in (1, 3):
+            lone, others = (inside, outside) if len(inside) == 1 else (outside, inside)
+            edges = [(lone[0], other) if len(inside) == 1 else (other, lone[0]) for other in others]
+            table[case, 0] = edges
+        elif len(inside) == 2:
+            (a, b), (c, d) = inside, outside
+            table[case, 0] = [(a, c), (a, d), (b, d)]
+            table[case, 1] = [(a, c), (b, d), (b, c)]
+    return table
+
+
+TETRAHEDRON_TABLE = _tetrahedron_table()
+
+
+def smooth_min(a, b, k):
+    # Polynomial smooth minimum, exactly min(a, b) when they are further than k apart.
+    if k <= 0:
+        return np.minimum(a, b)
+    h = np.maximum(k - np.abs(a - b), 0) / k
+    return np.minimum(a, b) - h * h * k * 0.25
+
+
+class CapsuleField:
+    # Smooth union of tapered capsules, one per bone, going from head radius to tail radius.
+    def __init__(self, heads, tails, head_radii, tail_radii, blend):
+        self.heads = np.asarray(heads, dtype=np.float64)
+        self.tails = np.asarray(tails, dtype=np.float64)
+        self.head_radii = np.asarray(head_radii, dtype=np.float64)
+        self.tail_radii = np.asarray(tail_radii, dtype=np.float64)
+        self.blend = blend
+
+        axis = self.tails - self.heads
+        self.axis = axis
+        self.length_squared = np.maximum((axis * axis).sum(axis=1), 1e-12)
+        # Bound of the gradient length of each capsule distance, used to cull capsules and blocks.
+        slope = np.abs(self.tail_radii - self.head_radii) / np.sqrt(self.length_squared)
+        self.lipschitz = np.sqrt(1 + slope * slope)
+
+    def bounds(self, margin=0.0):
+        radii = np.maximum(self.head_radii, self.tail_radii)[:, None]
+        low = np.minimum(self.heads, self.tails) - radii
+        high = np.maximum(self.heads, self.tails) + radii
+        return low.min(axis=0) - margin, high.max(axis=0) + margin
+
+    def capsule_distance(self, points, index):
+        pa = points - self.heads[index]
+        t = np.clip(pa.dot(self.axis[index]) / self.length_squared[index], 0, 1)
+        radius = self.head_radii[index] + (self.tail_radii[index] - self.head_radii[index]) * t
+        return np.linalg.norm(pa - self.axis[index] * t[:, None], axis=1) - radius
+
+    def distances(self, points):
+        # Distance of a few points to every capsule, (points, capsules).
+        return np.stack([self.capsule_distance(points, i) for i in range(len(self.heads))], axis=1)
+
+    def evaluate(self, points, capsules=None):
+        capsules = range(len(self.heads)) if capsules is None else capsules
+        field = np.full(len(points), np.inf)
+        for index in capsules:
+            field = smooth_min(field, self.capsule_distance(points, index), self.blend)
+        return field
+
+
+def active_blocks(field, origin, shape, cell_size, block_size, first=(0, 0, 0)):
+    # Finds the blocks that may contain surface, and the capsules that can influence each of them.
+    # A capsule further than blend from a whole block leaves the smooth minimum unchanged near the surface.
+    # Blocks tile the lattice from the first point on, and are returned by their starting lattice point.
+    first = np.array(first)
+    block_counts = -(-(np.array(shape) - 1 - first) // block_size)
+    starts = np.indices(block_counts).reshape(3, -1).T * block_size + first
+    centers = origin + (starts + 0.5 * block_size) * cell_size
+    half_diagonal = np.sqrt(3) * 0.5 * block_size * cell_size
+
+    distances = field.distances(centers)
+    reach = field.lipschitz[None, :] * half_diagonal
+    near = distances - reach < field.blend + 2 * np.sqrt(3) * cell_size
+    inside = (distances + reach < 0).any(axis=1)
+
+    blocks = []
+    for start, capsules, skip in zip(starts, near, inside):
+        if capsules.any() and not skip:
+            blocks.append((start, np.flatnonzero(capsules)))
+    return blocks
+
+
+def polygonize_block(field, origin, shape, cell_size, block_size, start, capsules):
+    # Marching tetrahedra over one block. Vertices are keyed by the global lattice edge they lie on,
+    # so results of different blocks weld together.
+    stop = np.minimum(start + block_size, np.array(shape) - 1)
+    cells = stop - start
+    if (cells <= 0).any():
+        return None
+
+    lattice = np.indices(cells + 1).reshape(3, -1).T + start
+    values = field.evaluate(origin + lattice * cell_size, capsules)
+    values[values == 0] = 1e-12
+    values = values.reshape(cells + 1)
+
+    inside = values < 0
+    if inside.all() or not inside.any():
+        return None
+
+    cell_index = np.indices(cells).reshape(3, -1).T
+    corner_index = cell_index[:, None, :] + CORNERS[None, :, :]
+    corner_values = values[corner_index[..., 0], corner_index[..., 1], corner_index[..., 2]]
+
+    # Drop cells without a sign change before going to the tetrahedra.
+    corner_inside = corner_values < 0
+    mixed = corner_inside.any(axis=1) & ~corner_inside.all(axis=1)
+    corner_index = corner_index[mixed] + start
+    corner_values = corner_values[mixed]
+
+    tet_corners = corner_index[:, TETRAHEDRA].reshape(-1, 4, 3)
+    tet_values = corner_values[:, TETRAHEDRA].reshape(-1, 4)
+    cases = ((tet_values < 0) * (1 << np.arange(4))).sum(axis=1)
+
+    triangles = TETRAHEDRON_TABLE[cases].reshape(-1, 3, 2)
+    owner = np.repeat(np.arange(len(cases)), 2)
+    valid = triangles[:, 0, 0] >= 0
+    triangles = triangles[valid]
+    owner = owner[valid]
+
+    corners_in = tet_corners[owner[:, None], triangles[..., 0]]
+    corners_out = tet_corners[owner[:, None], triangles[..., 1]]
+    values_in = tet_values[owner[:, None], triangles[..., 0]]
+    values_out = tet_values[owner[:, None], triangles[..., 1]]
+
+    t = values_in / (values_in - values_out)
+    co = origin + (corners_in + (corners_out - corners_in) * t[..., None]) * cell_size
+
+    # Orient every triangle so it faces from the inside corner to the outside one. Edge midpoints
+    # give the same winding as the interpolated points without their degenerate cases.
+    midpoints = corners_in + corners_out
+    normals = np.cross(midpoints[:, 1] - midpoints[:, 0], midpoints[:, 2] - midpoints[:, 0])
+    flip = (normals * (corners_out[:, 0] - corners_in[:, 0])).sum(axis=1) < 0
+    co[flip] = co[flip][:, ::-1]
+    corners_in[flip] = corners_in[flip][:, ::-1]
+    corners_out[flip] = corners_out[flip][:, ::-1]
+
+    stride = np.array([1, shape[0], shape[0] * shape[1]])
+    id_in = corners_in.dot(stride)
+    id_out = corners_out.dot(stride)
+    point_count = int(np.prod(shape))
+    keys = np.minimum(id_in, id_out) * point_count + np.maximum(id_in, id_out)
+
+    return keys.reshape(-1), co.reshape(-1, 3)
+
+
+def mirror_keys(keys, shape, plane):
+    # Keys of the lattice edges mirrored on the X plane at lattice index plane.
+    point_count = int(np.prod(shape))
+    ids = np.stack((keys // point_count, keys % point_count))
+    x = ids % shape[0]
+    ids += (2 * plane - 2 * x)
+    return ids.min(axis=0) * point_count + ids.max(axis=0)
+
+
+def polygonize(field, cell_size, block_size=24, threads=0, mirror=False):
+    # Returns welded vertex coordinates and triangle indices of the field surface.
+    # With mirror, the field is taken as symmetric on X: only the positive half is polygonized and
+    # mirrored, the X = 0 plane is a lattice plane so both halves share their seam vertices exactly.
+    low, high = field.bounds(field.blend + 2 * cell_size)
+    first = np.zeros(3, dtype=int)
+    if mirror:
+        plane = int(np.ceil(max(-low[0], high[0]) / cell_size))
+        low[0] = -plane * cell_size
+        high[0] = plane * cell_size
+        first[0] = plane
+    shape = tuple(np.round((high - low) / cell_size).astype(int) + 1)
+    blocks = active_blocks(field, low, shape, cell_size, block_size, first)
+
+    def work(item):
+        return polygonize_block(field, low, shape, cell_size, block_size, *item)
+
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        results = [result for result in pool.map(work, blocks) if result is not None]
+
+    if not results:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+
+    keys = np.concatenate([result[0] for result in results])
+    co = np.concatenate([result[1] for result in results])
+
+    if mirror:
+        # Vertices on the seam lie on lattice edges of the plane, put them exactly on it.
+        point_count = int(np.prod(shape))
+        seam = (keys // point_count % shape[0] == plane) & (keys % point_count % shape[0] == plane)
+        co[seam, 0] = 0
+        # Mirroring flips the winding, reverse every triangle to keep the normals out.
+        mirrored_keys = mirror_keys(keys, shape, plane).reshape(-1, 3)[:, ::-1].ravel()
+        mirrored_co = (co * (-1, 1, 1)).reshape(-1, 3, 3)[:, ::-1].reshape(-1, 3)
+        keys = np.concatenate((keys, mirrored_keys))
+        co = np.concatenate((co, mirrored_co))
+
+    unique, first, faces = np.unique(keys, return_index=True, return_inverse=True)
+    return co[first], faces.reshape(-1, 3)
@@ -0,0 +1,1182 @@
+# Numeric cores of the addon on plain arrays, without blender.
+# Meshes are (n, 3) vertex coordinates, the flat loop vertex indices and the number of loops of every face,
+# like mesh_arrays moves them in and out of blender. The operators only adapt blender data to these, so
+# everything here can be run, tested, profiled and benchmarked outside of a blender session
+# (see kernel_tests and kernel_benchmarks).
+# Nothing in this module may import bpy, bmesh or mathutils.
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from .profiling import profiler
+except ImportError:
+    from profiling import profiler
+
+
+# Mesh topology
+##################################
+
+def next_loops(loop_totals):
+    # Index of the following loop in the same face, for every loop.
+    starts = np.repeat(np.cumsum(loop_totals) - loop_totals, loop_totals)
+    return starts + (np.arange(len(starts)) - starts + 1) % np.repeat(loop_totals, loop_totals)
+
+
+def face_edges(loops, loop_totals):
+    # Sorted vertex pairs of every face side, one row per loop.
+    return np.sort(np.stack((loops, loops[next_loops(loop_totals)]), axis=1), axis=1)
+
+
+def edge_table(loops, loop_totals):
+    # Unique edges of the faces.
+    return np.unique(face_edges(loops, loop_totals), axis=0)
+
+
+def valences(vertex_count, loops, loop_totals):
+    # Number of edges linked to every vertex.
+    return np.bincount(edge_table(loops, loop_totals).ravel(), minlength=vertex_count)
+
+
+def vertex_adjacency(vertex_count, loops, loop_totals):
+    # Edge neighbours of every vertex in compressed rows: the neighbours of vertex i are
+    # indices[indptr[i]:indptr[i + 1]].
+    edges = edge_table(loops, loop_totals)
+    pairs = np.concatenate((edges, edges[:, ::-1]))
+    pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(pairs[:, 0], minlength=vertex_count))))
+    return indptr, pairs[:, 1]
+
+
+def vertex_normals(co, loops, loop_totals):
+    # Area weighted vertex normals, from the face normals of the loops.
+    face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+    crosses = np.cross(co[loops], co[loops[next_loops(loop_totals)]])
+    normals = np.zeros((len(co), 3))
+    for axis in range(3):
+        face_normals = np.bincount(face, crosses[:, axis], minlength=len(loop_totals))
+        normals[:, axis] = np.bincount(loops, face_normals[face], minlength=len(co))
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, None]
+
+
+def subdivided_counts(vertex_count, edge_count, face_count, loop_count, levels):
+    # Vertex, edge, face and loop counts after some Catmull-Clark levels, all faces become quads.
+    for _ in range(levels):
+        vertex_count, edge_count, face_count, loop_count = (vertex_count + edge_count + face_count,
+                                                            2 * edge_count + loop_count,
+                                                            loop_count, 4 * loop_count)
+    return vertex_count, edge_count, face_count, loop_count
+
+
+def catmull_clark(co, loops, loop_totals, out=None):
+    # One Catmull-Clark subdivision. Every loop becomes a quad over its vertex, the middle of its edge,
+    # the face center and the middle of the previous edge. Edge points follow the old vertices, then
+    # face points. Edges without exactly two faces use the boundary rules, vertices with more than two
+    # of them stay in place. out can be a preallocated array of at least the new vertex count, the new
+    # coordinates are written to its start and returned as a view of it.
+    face_count = len(loop_totals)
+    face = np.repeat(np.arange(face_count), loop_totals)
+    following = next_loops(loop_totals)
+    previous = np.empty_like(following)
+    previous[following] = np.arange(len(loops))
+    edges, edge_index = np.unique(np.sort(np.stack((loops, loops[following]), axis=1), axis=1),
+                                  axis=0, return_inverse=True)
+    edge_index = edge_index.ravel()
+
+    def mean(points, groups, count):
+        sums = np.stack([np.bincount(groups, points[:, axis], minlength=count) for axis in range(3)], axis=1)
+        return sums / np.maximum(np.bincount(groups, minlength=count), 1)[:, None]
+
+    face_points = mean(co[loops], face, face_count)
+
+    midpoints = (co[edges[:, 0]] + co[edges[:, 1]]) / 2
+    inner = np.bincount(edge_index, minlength=len(edges)) == 2
+    edge_points = midpoints.copy()
+    edge_points[inner] = (midpoints[inner] + mean(face_points[face], edge_index, len(edges))[inner]) / 2
+
+    ends = edges.ravel()
+    valence = np.bincount(ends, minlength=len(co))
+    face_means = mean(face_points[face], loops, len(co))
+    edge_midpoint_means = mean(np.repeat(midpoints, 2, axis=0), ends, len(co))
+    vertex_points = np.array(co, dtype=np.float64)
+    n = valence[:, None]
+    interior = valence > 0
+    vertex_points[interior] = ((face_means + 2 * edge_midpoint_means + (n - 3) * co) / np.maximum(n, 1))[interior]
+
+    # Boundary vertices only follow their two boundary edges.
+    boundary_ends = edges[~inner].ravel()
+    boundary_count = np.bincount(boundary_ends, minlength=len(co))
+    neighbours = edges[~inner][:, ::-1].ravel()
+    neighbour_sums = np.stack([np.bincount(boundary_ends, co[neighbours, axis], minlength=len(co))
+                               for axis in range(3)], axis=1)
+    on_boundary = boundary_count > 0
+    smooth_boundary = boundary_count == 2
+    vertex_points[on_boundary] = co[on_boundary]
+    vertex_points[smooth_boundary] = 0.75 * co[smooth_boundary] + 0.125 * neighbour_sums[smooth_boundary]
+
+    vertex_count = len(co)
+    edge_start = vertex_count
+    face_start = edge_start + len(edges)
+    new_count = face_start + face_count
+    if out is None:
+        out = np.empty((new_count, 3), dtype=np.float32)
+    out[:vertex_count] = vertex_points
+    out[edge_start:face_start] = edge_points
+    out[face_start:new_count] = face_points
+
+    # Written column by column, an int64 stack of the four would take twice the memory of the result.
+    new_loops = np.empty((len(loops), 4), dtype=np.int32)
+    new_loops[:, 0] = loops
+    new_loops[:, 1] = edge_start + edge_index
+    new_loops[:, 2] = face_start + face
+    new_loops[:, 3] = edge_start + edge_index[previous]
+    return out[:new_count], new_loops.ravel(), np.full(len(loops), 4, dtype=np.int32)
+
+
+def union_find(count, pairs):
+    # Disjoint sets of count elements joined by the pairs, as the smallest element of the set of each one.
+    # Every round hooks the root of each pair on the smaller root and then halves all paths,
+    # so it stops after a logarithmic number of vectorized rounds.
+    parent = np.arange(count)
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    while True:
+        a = parent[pairs[:, 0]]
+        b = parent[pairs[:, 1]]
+        if (a == b).all():
+            return parent
+        np.minimum.at(parent, np.maximum(a, b), np.minimum(a, b))
+        while True:
+            grand = parent[parent]
+            if (grand == parent).all():
+                break
+            parent = grand
+
+
+def vertex_faces(vertex_count, loops, loop_totals):
+    # Faces of every vertex in compressed rows, in face order: the faces of vertex i are
+    # faces[indptr[i]:indptr[i + 1]].
+    face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(loops, minlength=vertex_count))))
+    return indptr, face[np.argsort(loops, kind="stable")]
+
+
+# Remesh optimizer
+##################################
+
+def collapse_pairs(loops, loop_totals, valence):
+    # The diagonals to collapse in one optimize pass, as vertex pairs in face order.
+    # A face qualifies when it has more than one valence 3 vertex, then its 0-2 diagonal is collapsed
+    # if both ends have valence 3, otherwise its 1-3 diagonal under the same condition.
+    if not len(loop_totals):
+        return np.empty((0, 2), dtype=np.int64)
+    starts = np.cumsum(loop_totals) - loop_totals
+    qualifies = np.add.reduceat((valence[loops] == 3).astype(np.int64), starts) > 1
+    corners = [loops[starts + np.minimum(k, loop_totals - 1)] for k in range(4)]
+    is_three = [valence[corner] == 3 for corner in corners]
+
+    first = qualifies & is_three[0] & is_three[2]
+    second = qualifies & ~first & (loop_totals >= 4) & is_three[1] & is_three[3]
+    pairs = np.where(first[:, None],
+                     np.stack((corners[0], corners[2]), axis=1),
+                     np.stack((corners[1], corners[3]), axis=1))
+    return pairs[first | second]
+
+
+def apply_merges(co, pairs):
+    # Moves both vertices of every pair to their midpoint, in place.
+    # Pairs sharing a vertex with another pair see each other's results, so those are replayed in order,
+    # all the others are independent and done at once.
+    counts = np.bincount(pairs.ravel(), minlength=len(co))
+    independent = (counts[pairs[:, 0]] == 1) & (counts[pairs[:, 1]] == 1)
+    a, b = pairs[independent].T
+    co[a] = (co[a] + co[b]) / 2
+    co[b] = co[a]
+    for a, b in pairs[~independent]:
+        co[a] = (co[a] + co[b]) / 2
+        co[b] = co[a]
+
+
+def clean_faces(loops, loop_totals):
+    # Drops consecutive repeats of a vertex in every face, returns the remaining loops, the new face sizes
+    # and which faces are still valid. Faces under three corners, over a repeated vertex, or going over
+    # the same vertices as an earlier face are not, like after remove_doubles.
+    face_count = len(loop_totals)
+    face = np.repeat(np.arange(face_count), loop_totals)
+    keep = loops != loops[next_loops(loop_totals)]
+    loops = loops[keep]
+    face = face[keep]
+    loop_totals = np.bincount(face, minlength=face_count)
+
+    valid = loop_totals >= 3
+    order = np.lexsort((loops, face))
+    repeated = (face[order][1:] == face[order][:-1]) & (loops[order][1:] == loops[order][:-1])
+    valid[face[order][1:][repeated]] = False
+
+    if face_count:
+        # Faces over the same vertices as an earlier face.
+        starts = np.cumsum(loop_totals) - loop_totals
+        corners = np.full((face_count, loop_totals.max()), -1)
+        corners[face[order], np.arange(len(order)) - starts[face[order]]] = loops[order]
+        unique, first = np.unique(corners, axis=0, return_index=True)
+        duplicate = np.ones(face_count, dtype=bool)
+        duplicate[first] = False
+        valid &= ~duplicate
+
+    return loops, loop_totals, valid
+
+
+def weld_nonmanifold(co, loops, loop_totals):
+    # Welds the ends of every edge with more than two faces. Chains of such edges form clusters,
+    # each cluster goes to its centroid and merges into its first vertex in one remap, then the faces
+    # are cleaned like for the other welds and the merged vertices dropped.
+    edges, uses = np.unique(face_edges(loops, loop_totals), axis=0, return_counts=True)
+    pairs = edges[uses > 2]
+    if not len(pairs):
+        return co, loops, loop_totals
+
+    verts, local_pairs = np.unique(pairs, return_inverse=True)
+    clusters = union_find(len(verts), local_pairs)
+    sizes = np.bincount(clusters, minlength=len(verts))
+    centroids = np.stack([np.bincount(clusters, co[verts, axis], minlength=len(verts)) for axis in range(3)],
+                         axis=1) / np.maximum(sizes, 1)[:, None]
+
+    co = np.array(co)
+    co[verts] = centroids[clusters]
+    target = np.arange(len(co))
+    target[verts] = verts[clusters]
+
+    loops, loop_totals, valid = clean_faces(target[loops], loop_totals)
+    face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+    loops = loops[valid[face]]
+    loop_totals = loop_totals[valid]
+
+    alive = target == np.arange(len(co))
+    new_index = np.cumsum(alive) - 1
+    return co[alive], new_index[loops], loop_totals
+
+
+def ranges(starts, counts):
+    # Concatenated index ranges, the same as joining np.arange(start, start + count) for every pair.
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+class TopologyOptimizer:
+    # Collapses the valence 3 diagonals left by the remesh modifier, on flat arrays.
+    # After the first pass only the faces around the last merges are scanned again, and passes stop
+    # as soon as one finds nothing to collapse, so the cost follows the number of defects.
+    # Vertices and faces keep their original indices until arrays() compacts them.
+    def __init__(self, co, loops, loop_totals):
+        loops = np.asarray(loops)
+        loop_totals = np.asarray(loop_totals)
+        self.co = np.array(co, dtype=np.float32)
+        # Every face keeps its original loop range, shrinking faces use the start of it.
+        self.starts = np.cumsum(loop_totals) - loop_totals
+        self.slots = loops.copy()
+        self.totals = loop_totals.copy()
+        self.alive = np.ones(len(loop_totals), dtype=bool)
+        # Vertex each vertex was merged into, and the vertices merged into each surviving one.
+        self.root = np.arange(len(self.co))
+        self.members = {}
+
+        # Faces of every vertex, by original index.
+        self.vertex_face_starts, self.vertex_faces = vertex_faces(len(self.co), loops, loop_totals)
+
+        self.passes = 0
+        self.merges = 0
+
+        self.clean(np.arange(len(loop_totals)))
+        self.dirty = np.flatnonzero(self.alive)
+        self.valence = valences(len(self.co), *self.face_loops(self.dirty))
+
+    def face_loops(self, faces):
+        totals = self.totals[faces]
+        return self.slots[ranges(self.starts[faces], totals)], totals
+
+    def faces_around(self, verts):
+        # Sorted living faces using any of the given vertices.
+        originals = np.concatenate([verts] + [self.members[v] for v in verts.tolist() if v in self.members])
+        counts = np.diff(self.vertex_face_starts)[originals]
+        faces = np.unique(self.vertex_faces[ranges(self.vertex_face_starts[originals], counts)])
+        return faces[self.alive[faces]]
+
+    def clean(self, faces):
+        loops, totals = self.face_loops(faces)
+        loops, totals, valid = clean_faces(self.root[loops], totals)
+        self.slots[ranges(self.starts[faces], totals)] = loops
+        self.totals[faces] = totals
+        self.alive[faces[~valid]] = False
+
+    def weld(self, verts):
+        # Merges the given vertices that ended on exactly the same position into the first one of them.
+        unique, inverse = np.unique(self.co[verts], axis=0, return_inverse=True)
+        first = np.full(len(unique), len(self.co))
+        np.minimum.at(first, inverse.ravel(), verts)
+        targets = first[inverse.ravel()]
+        for vertex, target in zip(verts.tolist(), targets.tolist()):
+            if vertex != target:
+                self.members[target] = np.concatenate((self.members.get(target, []), [vertex],
+                                                       self.members.pop(vertex, []))).astype(np.int64)
+        self.root[verts] = targets
+
+    def update_valences(self, verts):
+        # Recounts the edges of the given vertices, all of them belong to the faces around.
+        faces = self.faces_around(verts)
+        edges = np.unique(face_edges(*self.face_loops(faces)), axis=0)
+        ends, counts = np.unique(edges, return_counts=True)
+        counted = np.isin(ends, verts)
+        self.valence[verts] = 0
+        self.valence[ends[counted]] = counts[counted]
+        return faces
+
+    def step(self):
+        # One optimize pass over the dirty faces, returns False when there was nothing to collapse.
+        with profiler.span("optimize pass", faces=len(self.dirty)):
+            return self.collapse()
+
+    def collapse(self):
+        pairs = collapse_pairs(*self.face_loops(self.dirty), self.valence)
+        if not len(pairs):
+            return False
+        apply_merges(self.co, pairs)
+
+        verts = np.unique(pairs)
+        affected = self.faces_around(verts)
+        touched = np.unique(self.face_loops(affected)[0])
+        self.weld(verts)
+        self.clean(affected)
+
+        # Faces around vertices whose valence may have changed are the only ones that can qualify next.
+        touched = touched[self.root[touched] == touched]
+        self.dirty = self.update_valences(touched)
+        self.passes += 1
+        self.merges += len(pairs)
+        profiler.count("merges", len(pairs))
+        return True
+
+    def run(self, iterations):
+        for _ in range(iterations):
+            if not self.step():
+                break
+        return self
+
+    def arrays(self):
+        loops, loop_totals = self.face_loops(np.flatnonzero(self.alive))
+        alive = self.root == np.arange(len(self.co))
+        new_index = np.cumsum(alive) - 1
+        return self.co[alive], new_index[loops], loop_totals
+
+
+def optimize_topology(co, loops, loop_totals, iterations):
+    return TopologyOptimizer(co, loops, loop_totals).run(iterations).arrays()
+
+
+def laplacian_smooth(co, indptr, indices, factor):
+    # One step of the smooth modifier: every vertex moves towards the average of its edge midpoints.
+    counts = np.diff(indptr)
+    rows = np.repeat(np.arange(len(co)), counts)
+    sums = np.stack([np.bincount(rows, co[indices, axis], minlength=len(co)) for axis in range(3)], axis=1)
+    linked = counts > 0
+    midpoints = (co[linked] + sums[linked] / counts[linked, None]) / 2
+    co[linked] += (midpoints - co[linked]) * factor
+
+
+def smooth_and_project(co, loops, loop_totals, projector, iterations, factor, chunk_size=0):
+    # Alternates smoothing and projecting back on the original surface, all on the coordinate array.
+    co = np.array(co, dtype=np.float64)
+    indptr, indices = vertex_adjacency(len(co), loops, loop_totals)
+    for _ in range(iterations):
+        with profiler.span("smooth iteration", vertices=len(co)):
+            laplacian_smooth(co, indptr, indices, factor)
+            projector.project(co, vertex_normals(co, loops, loop_totals), chunk_size)
+    return co
+
+
+def subdivide_and_project(co, loops, loop_totals, projector, levels, chunk_size=0):
+    # Catmull-Clark levels, each one projected on the original surface.
+    # The coordinates of the last level are allocated once, every level is built in the same array.
+    # chunk_size is only handed to the projector, the subdivision works on the whole mesh.
+    counts = subdivided_counts(len(co), len(edge_table(loops, loop_totals)), len(loop_totals), len(loops), levels)
+    buffer = np.empty((counts[0], 3), dtype=np.float32)
+    buffer[:len(co)] = co
+    co = buffer[:len(co)]
+    for level in range(levels):
+        with profiler.span("subdivision level", level=level + 1):
+            co, loops, loop_totals = catmull_clark(co, loops, loop_totals, out=buffer)
+            projector.project(co, vertex_normals(co, loops, loop_totals), chunk_size)
+    return co, loops, loop_totals
+
+
+# Envelope meshes
+##################################
+
+class ProfileLevel:
+    # One level of detail of a profile, as flat arrays.
+    def __init__(self, co, loops, loop_totals):
+        self.co = co
+        self.loops = loops
+        self.loop_totals = loop_totals
+        self.flipped_loops = flip_faces(loops, loop_totals)
+
+
+class ProfileLibrary:
+    # Library of the levels of detail of a profile shape.
+    # The base level is given as arrays, or comes from calling load_base the first time it is needed,
+    # every finer level is a subdivision of the previous one.
+    max_level = 3
+    # Bones with a radius of this fraction of the armature size get the full quality level,
+    # every halving of the radius drops one level.
+    reference_radius = 1 / 16
+
+    def __init__(self, base=None, load_base=None):
+        if base is None and load_base is None:
+            raise ValueError("A profile library needs its base arrays or a loader for them")
+        self.profiles = {}
+        self.load_base = load_base
+        if base is not None:
+            self.profiles[0] = ProfileLevel(*base)
+
+    def level(self, level):
+        level = min(max(int(level), 0), self.max_level)
+        if level not in self.profiles:
+            if level == 0:
+                arrays = self.load_base()
+            else:
+                coarse = self.level(level - 1)
+                arrays = subdivide_profile(coarse.co, coarse.loops, coarse.loop_totals)
+            self.profiles[level] = ProfileLevel(*arrays)
+        return self.profiles[level]
+
+    # Cache the profile as flat arrays, every ring is then just a scaled
+    # and translated copy of these.
+    @property
+    def co(self):
+        return self.level(0).co
+
+    @property
+    def loops(self):
+        return self.level(0).loops
+
+    @property
+    def loop_totals(self):
+        return self.level(0).loop_totals
+
+    def vertex_counts(self, levels):
+        counts = np.array([len(self.level(level).co) for level in range(self.max_level + 1)])
+        return counts[levels]
+
+    def choose_levels(self, radii, size, quality, adaptive=True):
+        # Level of detail of every bone, the quality level for big bones and coarser ones for small bones.
+        quality = min(max(int(quality), 0), self.max_level)
+        if not adaptive or size <= 0:
+            return np.full(len(radii), quality, dtype=np.int64)
+        relative = np.maximum(radii, 1e-9) / (size * self.reference_radius)
+        return np.clip(quality + np.floor(np.log2(relative)), 0, quality).astype(np.int64)
+
+    def ring_co(self, params, step_size, min_steps):
+        # Ring vertices of bones given as rows of head, tail, head radius, tail radius and level, in bone order.
+        levels = params[:, 8].astype(np.int64)
+        steps = bone_steps(params[:, :3], params[:, 3:6], step_size, min_steps)
+        sizes = (steps + 1) * self.vertex_counts(levels)
+        ends = np.cumsum(sizes)
+        slices = np.stack((ends - sizes, ends), axis=1)
+
+        co = np.empty((ends[-1] if len(ends) else 0, 3), dtype=np.float32)
+        for level in np.unique(levels):
+            bones = np.flatnonzero(levels == level)
+            rows = params[bones]
+            co[slice_index(slices[bones])] = ring_vertices(rows[:, :3], rows[:, 3:6], rows[:, 6], rows[:, 7],
+                                                           step_size, min_steps, self.level(level).co)
+        return co
+
+    def topology(self, steps, levels, flipped=False, offset=0):
+        # Faces of consecutive bones with the given steps and levels of detail.
+        loops = [np.empty(0, dtype=np.int64)]
+        loop_totals = [np.empty(0, dtype=np.int64)]
+        for bone_steps, level in zip(steps, levels):
+            profile = self.level(level)
+            bone_loops, bone_loop_totals = ring_topology(bone_steps + 1, len(profile.co),
+                                                         profile.flipped_loops if flipped else profile.loops,
+                                                         profile.loop_totals)
+            loops.append(bone_loops + offset)
+            loop_totals.append(bone_loop_totals)
+            offset += (bone_steps + 1) * len(profile.co)
+        return np.concatenate(loops), np.concatenate(loop_totals)
+
+    def bones_to_arrays(self, bones, step_size, min_steps, local=False, quality=2, adaptive=True):
+        # The rings of all bones at once, as (co, loops, loop_totals).
+        params = np.column_stack(bone_arrays(bones, local))
+        levels = self.choose_levels(np.maximum(params[:, 6], params[:, 7]), armature_size(params), quality, adaptive)
+        params = np.column_stack((params, levels))
+
+        co = self.ring_co(params, step_size, min_steps)
+        loops, loop_totals = self.topology(bone_steps(params[:, :3], params[:, 3:6], step_size, min_steps), levels)
+        return co, loops, loop_totals
+
+
+def bone_arrays(bones, local=False):
+    # Collects head, tail and radius of each bone in numpy arrays.
+    # Bones use the tail radius of their parent as the head radius when they have one.
+    # local=True reads head_local/tail_local, needed for armature.data.bones.
+    bones = list(bones)
+    heads = np.empty((len(bones), 3))
+    tails = np.empty((len(bones), 3))
+    head_radii = np.empty(len(bones))
+    tail_radii = np.empty(len(bones))
+
+    for i, bone in enumerate(bones):
+        heads[i] = bone.head_local if local else bone.head
+        tails[i] = bone.tail_local if local else bone.tail
+        head_radii[i] = bone.parent.tail_radius if bone.parent else bone.head_radius
+        tail_radii[i] = bone.tail_radius
+
+    return heads, tails, head_radii, tail_radii
+
+
+def armature_size(params):
+    # Diagonal of the box around every head and tail.
+    if not len(params):
+        return 0.0
+    points = np.concatenate((params[:, :3], params[:, 3:6]))
+    return float(np.linalg.norm(points.max(axis=0) - points.min(axis=0)))
+
+
+def bone_steps(heads, tails, step_size, min_steps):
+    # Number of steps per bone, never less than min_steps.
+    lengths = np.linalg.norm(tails - heads, axis=1)
+    steps = np.maximum(np.round(lengths / step_size), min_steps)
+    return np.maximum(steps, 1).astype(np.int64)
+
+
+def step_factors(steps):
+    # Bone index and interpolation factor of every step, given the number of steps of each bone.
+    counts = steps + 1
+    bone_index = np.repeat(np.arange(len(steps)), counts)
+    starts = np.cumsum(counts) - counts
+    factors = (np.arange(counts.sum()) - starts[bone_index]) / steps[bone_index]
+    return bone_index, factors
+
+
+def adaptive_factors(heads, tails, head_radii, tail_radii, fraction):
+    # Steps spaced by a fraction of the interpolated radius instead of a fixed size.
+    # Along a linear taper that spacing makes the radius grow geometrically from step to step,
+    # so the steps are uniform in log space.
+    lengths = np.linalg.norm(tails - heads, axis=1)
+    head_radii = np.maximum(head_radii, 1e-4)
+    tail_radii = np.maximum(tail_radii, 1e-4)
+    ratio = tail_radii / head_radii
+    tapered = np.abs(ratio - 1) > 1e-6
+    difference = np.where(tapered, tail_radii - head_radii, 1)
+
+    span = np.where(tapered,
+                    lengths * np.log(ratio) / (fraction * difference),
+                    lengths / (fraction * head_radii))
+    steps = np.maximum(np.ceil(span), 1).astype(np.int64)
+
+    bone_index, factors = step_factors(steps)
+    growth = (ratio[bone_index] ** factors - 1) / np.where(tapered, ratio - 1, 1)[bone_index]
+    factors = np.where(tapered[bone_index], growth, factors)
+    return bone_index, factors
+
+
+def element_placement(heads, tails, head_radii, tail_radii, step_size, min_steps, fraction=None):
+    # Positions and radii of the metaball elements of every bone. With a fraction the spacing
+    # adapts to the bone radius, otherwise it is step_size with min_steps per bone.
+    if fraction:
+        bone_index, factors = adaptive_factors(heads, tails, head_radii, tail_radii, fraction)
+    else:
+        bone_index, factors = step_factors(bone_steps(heads, tails, step_size, min_steps))
+
+    co = heads[bone_index] + (tails - heads)[bone_index] * factors[:, None]
+    radii = head_radii[bone_index] + (tail_radii - head_radii)[bone_index] * factors
+    return co, radii, bone_index
+
+
+def ring_vertices(heads, tails, head_radii, tail_radii, step_size, min_steps, profile_co):
+    # Places one copy of the profile per step of every bone in a single broadcasted transform.
+    centers, radii, bone_index = element_placement(heads, tails, head_radii, tail_radii, step_size, min_steps)
+    co = profile_co[None, :, :] * radii[:, None, None] + centers[:, None, :]
+    return co.reshape(-1, 3)
+
+
+def envelope_rings(heads, tails, head_radii, tail_radii, step_size, min_steps,
+                   profile_co, profile_loops, profile_loop_totals):
+    co = ring_vertices(heads, tails, head_radii, tail_radii, step_size, min_steps, profile_co)
+    loops, loop_totals = ring_topology(len(co) // len(profile_co), len(profile_co), profile_loops, profile_loop_totals)
+    return co, loops, loop_totals
+
+
+def ring_topology(rings, vert_count, profile_loops, profile_loop_totals):
+    # Face indices of a number of consecutive profile copies.
+    offsets = np.arange(rings) * vert_count
+    loops = (profile_loops[None, :] + offsets[:, None]).ravel()
+    loop_totals = np.tile(profile_loop_totals, rings)
+    return loops, loop_totals
+
+
+def subdivide_profile(co, loops, loop_totals):
+    # Splits every n-gon into n quads around its center. New points are pushed out to the mean
+    # distance of their parents from the origin, so round (star shaped) profiles stay round.
+    starts = np.cumsum(loop_totals) - loop_totals
+    face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+    position = np.arange(len(loops)) - starts[face]
+    following = loops[starts[face] + (position + 1) % loop_totals[face]]
+    previous_loop = starts[face] + (position - 1) % loop_totals[face]
+
+    edges = np.sort(np.stack((loops, following), axis=1), axis=1)
+    edges, edge_index = np.unique(edges, axis=0, return_inverse=True)
+    edge_index = edge_index.ravel()
+
+    def radial_mean(points, groups, count):
+        total = np.zeros((count, 3))
+        np.add.at(total, groups, points)
+        length = np.zeros(count)
+        np.add.at(length, groups, np.linalg.norm(points, axis=1))
+        direction = total / np.maximum(np.linalg.norm(total, axis=1), 1e-12)[:, None]
+        return direction * (length / np.bincount(groups, minlength=count))[:, None]
+
+    midpoints = radial_mean(co[edges.ravel()], np.repeat(np.arange(len(edges)), 2), len(edges))
+    centers = radial_mean(co[loops], face, len(loop_totals))
+
+    edge_start = len(co)
+    center_start = edge_start + len(edges)
+    new_loops = np.stack((loops,
+                          edge_start + edge_index,
+                          center_start + face,
+                          edge_start + edge_index[previous_loop]), axis=1).ravel()
+    new_co = np.concatenate((co, midpoints, centers)).astype(np.float32)
+    return new_co, new_loops.astype(np.int32), np.full(len(loops), 4, dtype=np.int32)
+
+
+def flip_faces(loops, loop_totals):
+    # Reverses the winding of every face, needed after mirroring.
+    starts = np.repeat(np.cumsum(loop_totals) - loop_totals, loop_totals)
+    ends = np.repeat(np.cumsum(loop_totals) - 1, loop_totals)
+    return loops[starts + ends - np.arange(len(loops))]
+
+
+def flip_name(name):
+    # Name of the symmetric bone by the usual blender conventions: .L/.R, _L/_R, -L/-R and Left/Right.
+    match = re.match(r"^(.*[._\- ])([LlRr])$", name)
+    if match:
+        side = match.group(2)
+        return match.group(1) + {"L": "R", "R": "L", "l": "r", "r": "l"}[side]
+    for left, right in (("Left", "Right"), ("left", "right"), ("LEFT", "RIGHT")):
+        if left in name:
+            return name.replace(left, right)
+        if right in name:
+            return name.replace(right, left)
+    return name
+
+
+def mirror_plan(names, params, tolerance=1e-4):
+    # Splits the bones in the ones that need to be generated (sources) and, among those, the ones
+    # whose result is mirrored on X to give their symmetric partner (indices into sources).
+    # Bones pair by name first and by position otherwise, but a pair only counts when the two
+    # bones are mirror images within tolerance, radii included. Centre bones are never mirrored.
+    # Also returns which bones are paired and which are centred, every bone is one or the other only
+    # when the whole armature is symmetric.
+    mirrored_params = params.copy()
+    mirrored_params[:, [0, 3]] *= -1
+    center = (np.abs(params[:, [0, 3]]) <= tolerance).all(axis=1)
+    matches = (np.abs(params[:, None, :] - mirrored_params[None, :, :]) <= tolerance).all(axis=2)
+    matches[center] = False
+    matches[:, center] = False
+    np.fill_diagonal(matches, False)
+
+    index = {name: i for i, name in enumerate(names)}
+    partner = np.full(len(names), -1)
+    for i in np.flatnonzero(matches.any(axis=1)):
+        j = index.get(flip_name(names[i]), -1)
+        partner[i] = j if j >= 0 and matches[i, j] else np.argmax(matches[i])
+
+    paired = partner >= 0
+    paired[paired] = partner[partner[paired]] == np.flatnonzero(paired)
+    # Keep the bone on the positive side of each pair.
+    side = params[:, 0] + params[:, 3]
+    keep = ~paired | (side > 0) | ((side == 0) & (np.arange(len(names)) < partner))
+
+    sources = np.flatnonzero(keep)
+    mirrored = np.flatnonzero(paired[sources])
+    return sources, mirrored, paired, center
+
+
+def slice_index(slices):
+    # Indices covered by a list of (start, stop) ranges, in order.
+    if not len(slices):
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, stop) for start, stop in slices])
+
+
+# Cross and position fields
+##################################
+
+def curvature_field(vert_normals, face_normals, indptr, faces):
+    # For every vertex, the largest difference between the normal of one of its faces and its own normal.
+    # A segmented argmax over the vertex faces, ties go to the last face. Loose vertices get zero.
+    vertex_count = len(indptr) - 1
+    vertex = np.repeat(np.arange(vertex_count), np.diff(indptr))
+    vecs = face_normals[faces] - vert_normals[vertex]
+    order = np.lexsort(((vecs * vecs).sum(axis=1), vertex))
+    field = np.zeros((vertex_count, 3), dtype=vecs.dtype)
+    last = indptr[1:] - 1
+    linked = np.diff(indptr) > 0
+    field[linked] = vecs[order[last[linked]]]
+    return field
+
+
+class CurvatureField:
+    # Direction of strongest curvature of every vertex of a mesh and what proximity queries need:
+    # the normalized field and its cross direction at every vertex and the face corners.
+    def __init__(self, co, vert_normals, face_normals, loops, loop_totals):
+        self.co = co
+        self.vert_normals = vert_normals
+        self.field = curvature_field(vert_normals, face_normals, *vertex_faces(len(co), loops, loop_totals))
+        self.scores = (self.field * self.field).sum(axis=1)
+
+        lengths = np.sqrt(self.scores)
+        self.directions = self.field / np.where(lengths > 0, lengths, 1)[:, None]
+        self.crosses = np.cross(self.directions, vert_normals)
+        self.loops = loops
+        self.loop_starts = np.cumsum(loop_totals) - loop_totals
+        self.loop_totals = loop_totals
+
+    def choose(self, n):
+        # The n highest scores, lowest first. A partial selection finds them, only they get sorted,
+        # ties keep the later vertices like a stable sort of all scores would.
+        scores = self.scores
+        n = min(n, len(scores))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64)
+        threshold = np.partition(scores, len(scores) - n)[len(scores) - n]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)
+        chosen = np.concatenate((above, tied[len(tied) - (n - len(above)):]))
+        return chosen[np.lexsort((chosen, scores[chosen]))]
+
+    def face_directions(self, faces):
+        # Field over each of the faces. The directions of the corners are summed, each one first turned
+        # to the one of its four cross directions that agrees most with the sum so far, then averaged.
+        starts = self.loop_starts[faces]
+        totals = self.loop_totals[faces]
+
+        result = self.directions[self.loops[starts]].astype(np.float64)
+        for corner in range(1, int(totals.max()) if len(faces) else 0):
+            has_corner = corner < totals
+            vert = self.loops[starts[has_corner] + corner]
+            candidates = np.stack((self.directions[vert], -self.directions[vert],
+                                   self.crosses[vert], -self.crosses[vert]), axis=1)
+            dots = (candidates * result[has_corner, None]).sum(axis=2)
+            # The last of equal best ones, like a stable sort would give.
+            best = 3 - dots[:, ::-1].argmax(axis=1)
+            result[has_corner] += candidates[np.arange(len(vert)), best]
+        return result / np.maximum(totals, 1)[:, None]
+
+
+def align_rosy(directions, normals, targets):
+    # The one of the four cross directions of every direction (turned around its normal) that agrees
+    # most with its target.
+    turned = np.cross(normals, directions)
+    a = (directions * targets).sum(axis=1)
+    b = (turned * targets).sum(axis=1)
+    straight = np.abs(a) >= np.abs(b)
+    return np.where(straight[:, None], directions * np.where(a < 0, -1, 1)[:, None],
+                    turned * np.where(b < 0, -1, 1)[:, None])
+
+
+def tangent(directions, normals, fallback):
+    # Directions projected on the tangent planes and normalized, the fallback where nothing is left.
+    directions = directions - normals * (directions * normals).sum(axis=1)[:, None]
+    lengths = np.linalg.norm(directions, axis=1)
+    valid = lengths > 1e-12
+    return np.where(valid[:, None], directions / np.where(valid, lengths, 1)[:, None], fallback)
+
+
+def match_vertices(count, edges, seed=0):
+    # Clusters of one or two vertices joined by an edge, roughly halving the count.
+    # Every free vertex proposes to its free neighbour of highest random priority, mutual proposals pair up.
+    priority = np.random.RandomState(seed).permutation(count)
+    cluster = np.full(count, -1)
+    source = np.concatenate((edges[:, 0], edges[:, 1]))
+    target = np.concatenate((edges[:, 1], edges[:, 0]))
+    index = np.arange(count)
+    for _ in range(3):
+        free = cluster < 0
+        usable = free[source] & free[target]
+        s, t = source[usable], target[usable]
+        if not len(s):
+            break
+        order = np.lexsort((priority[t], s))
+        last = order[np.concatenate((s[order][1:] != s[order][:-1], [True]))]
+        choice = np.full(count, -1)
+        choice[s[last]] = t[last]
+        first = np.flatnonzero((choice > index) & (choice[np.maximum(choice, 0)] == index))
+        cluster[first] = first
+        cluster[choice[first]] = first
+    cluster[cluster < 0] = index[cluster < 0]
+    return np.unique(cluster, return_inverse=True)[1].ravel()
+
+
+class CrossFieldLevel:
+    def __init__(self, normals, edges, seeds, weights):
+        self.normals = normals
+        self.edges = edges
+        self.seeds = seeds
+        self.weights = weights
+        self.directions = seeds.copy()
+        self.clusters = None
+
+    def coarsen(self, seed=0):
+        # The next level, with the vertex pairs of this one merged. Clusters keep the seed of their
+        # strongest vertex, and its weight.
+        clusters = match_vertices(len(self.normals), self.edges, seed)
+        count = clusters.max() + 1
+        normals = np.stack([np.bincount(clusters, self.normals[:, axis], minlength=count) for axis in range(3)],
+                           axis=1)
+        normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+        edges = clusters[self.edges]
+        edges = np.unique(np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1), axis=0)
+
+        order = np.lexsort((self.weights, clusters))
+        strongest = order[np.concatenate((clusters[order][1:] != clusters[order][:-1], [True]))]
+        seeds = tangent(self.seeds[strongest], normals, self.seeds[strongest])
+        self.clusters = clusters
+        return CrossFieldLevel(normals, edges, seeds, self.weights[strongest])
+
+    def sweep(self):
+        # One Jacobi sweep: every direction becomes the sum of itself, its neighbours and its weighted seed,
+        # all turned to agree with it first. Returns the mean change, 0 to 1 with 4 fold symmetry.
+        directions = self.directions
+        i, j = self.edges[:, 0], self.edges[:, 1]
+        sums = directions.copy()
+        for a, b in ((i, j), (j, i)):
+            aligned = align_rosy(directions[b], self.normals[b], directions[a])
+            sums += np.stack([np.bincount(a, aligned[:, axis], minlength=len(directions)) for axis in range(3)],
+                             axis=1)
+        sums += self.weights[:, None] * align_rosy(self.seeds, self.normals, directions)
+        self.directions = tangent(sums, self.normals, directions)
+        change = np.abs((align_rosy(self.directions, self.normals, directions) * directions).sum(axis=1))
+        return float(1 - change.mean()) if len(change) else 0.0
+
+    def prolong(self, fine):
+        # Hands the directions down to the finer level this one was coarsened from.
+        fine.directions = tangent(self.directions[fine.clusters], fine.normals, fine.directions)
+
+
+class CrossFieldSolver:
+    # Smooth 4-RoSy cross field over the mesh of a curvature field, seeded from its directions.
+    # Seeds pull on the field by their curvature score, times anchor. The field is smoothed from the
+    # coarsest level of a vertex cluster hierarchy down to the mesh, so few sweeps are needed per level.
+    # steps() yields progress after every sweep and can be left at any time, field() is always usable.
+    def __init__(self, field, anchor=1.0, min_vertices=64, max_levels=12):
+        edges = edge_table(field.loops, field.loop_totals)
+        scores = field.scores / max(field.scores.max(), 1e-12) if len(field.scores) else field.scores
+        normals = field.vert_normals.astype(np.float64)
+        # Vertices without a field start from any tangent direction.
+        axis = np.where((np.abs(normals[:, 0]) < 0.9)[:, None], [1.0, 0, 0], [0, 1.0, 0])
+        seeds = tangent(field.directions.astype(np.float64), normals, tangent(axis, normals, axis))
+
+        self.levels = [CrossFieldLevel(normals, edges, seeds, anchor * scores)]
+        while len(self.levels[-1].normals) > min_vertices and len(self.levels) < max_levels:
+            coarse = self.levels[-1].coarsen(seed=len(self.levels))
+            if len(coarse.normals) > 0.9 * len(self.levels[-1].normals):
+                self.levels[-1].clusters = None
+                break
+            self.levels.append(coarse)
+        self.current = len(self.levels) - 1
+
+    def steps(self, tolerance=1e-4, max_iterations=100):
+        # Yields (level, iteration, residual) after every sweep, coarsest level first. A level is left when
+        # the residual drops under tolerance or after max_iterations sweeps.
+        for index in range(len(self.levels) - 1, -1, -1):
+            self.current = index
+            level = self.levels[index]
+            for iteration in range(max_iterations):
+                residual = level.sweep()
+                yield index, iteration, residual
+                if residual < tolerance:
+                    break
+            if index > 0:
+                level.prolong(self.levels[index - 1])
+
+    def solve(self, tolerance=1e-4, max_iterations=100):
+        for _ in self.steps(tolerance, max_iterations):
+            pass
+        return self.field()
+
+    def field(self):
+        # Directions at the mesh vertices, handed down from wherever the solver stopped.
+        for index in range(self.current, 0, -1):
+            self.levels[index].prolong(self.levels[index - 1])
+        self.current = 0
+        return self.levels[0].directions
+
+
+def map_chunks(pool, function, count, chunk_size=1 << 16):
+    # function(start, stop) over consecutive slices of count items, on the pool when there is one.
+    slices = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    if pool is None or len(slices) < 2:
+        return [function(*item) for item in slices]
+    return list(pool.map(lambda item: function(*item), slices))
+
+
+def middle_points(p0, n0, p1, n1):
+    # Points close to the middle of p0 and p1 lying on both tangent planes as much as possible.
+    n0p0 = (n0 * p0).sum(axis=1)
+    n0p1 = (n0 * p1).sum(axis=1)
+    n1p0 = (n1 * p0).sum(axis=1)
+    n1p1 = (n1 * p1).sum(axis=1)
+    n0n1 = (n0 * n1).sum(axis=1)
+    denominator = 1 / (1 - n0n1 * n0n1 + 1e-4)
+    lambda0 = 2 * (n0p1 - n0p0 - n0n1 * (n1p0 - n1p1)) * denominator
+    lambda1 = 2 * (n1p0 - n1p1 - n0n1 * (n0p1 - n0p0)) * denominator
+    return 0.5 * (p0 + p1) - 0.25 * (n0 * lambda0[:, None] + n1 * lambda1[:, None])
+
+
+def lattice_point(origins, q, t, points, scale, rounding=np.round):
+    # The point of the square lattice through origins, spanned by q and t, next to the points.
+    # With floor, the lowest corner of the lattice square holding them.
+    d = points - origins
+    a = rounding((q * d).sum(axis=1) / scale)
+    b = rounding((t * d).sum(axis=1) / scale)
+    return origins + (q * a[:, None] + t * b[:, None]) * scale
+
+
+def compat_positions(co0, n0, q0, o0, co1, n1, q1, o1, scale):
+    # The closest pair of points of the two lattices around the middle of co0 and co1.
+    # The directions q1 must already agree with q0.
+    t0 = np.cross(n0, q0)
+    t1 = np.cross(n1, q1)
+    middle = middle_points(co0, n0, co1, n1)
+    base0 = lattice_point(o0, q0, t0, middle, scale, np.floor)
+    base1 = lattice_point(o1, q1, t1, middle, scale, np.floor)
+    steps = np.array([[0, 0], [1, 0], [0, 1], [1, 1]]) * scale
+    corners0 = base0[:, None] + q0[:, None] * steps[None, :, 0, None] + t0[:, None] * steps[None, :, 1, None]
+    corners1 = base1[:, None] + q1[:, None] * steps[None, :, 0, None] + t1[:, None] * steps[None, :, 1, None]
+    distances = ((corners0[:, :, None] - corners1[:, None, :]) ** 2).sum(axis=3).reshape(-1, 16)
+    best = distances.argmin(axis=1)
+    rows = np.arange(len(best))
+    return corners0[rows, best // 4], corners1[rows, best % 4]
+
+
+class PositionFieldLevel:
+    def __init__(self, co, normals, edges, directions, scale):
+        self.co = co
+        self.normals = normals
+        self.edges = edges
+        self.directions = directions
+        self.scale = scale
+        self.positions = co.copy()
+        self.clusters = None
+
+    def lattice_round(self, positions):
+        # Keeps the positions on the tangent planes, at the lattice point closest to the vertex.
+        positions = positions - self.normals * (self.normals * (positions - self.co)).sum(axis=1)[:, None]
+        return lattice_point(positions, self.directions, np.cross(self.normals, self.directions), self.co, self.scale)
+
+    def sweep(self, pool=None):
+        # One Jacobi sweep: every lattice moves by the mean translation that matches it with its neighbours.
+        # Returns the mean move in units of the lattice spacing.
+        i, j = self.edges[:, 0], self.edges[:, 1]
+
+        def translations(start, stop):
+            a = np.concatenate((i[start:stop], j[start:stop]))
+            b = np.concatenate((j[start:stop], i[start:stop]))
+            q = self.directions[a]
+            first, second = compat_positions(self.co[a], self.normals[a], q, self.positions[a], self.co[b],
+                                             self.normals[b], align_rosy(self.directions[b], self.normals[b], q),
+                                             self.positions[b], self.scale)
+            return a, second - first
+
+        results = map_chunks(pool, translations, len(i))
+        count = len(self.co)
+        if not results:
+            return 0.0
+        a = np.concatenate([result[0] for result in results])
+        moves = np.concatenate([result[1] for result in results])
+        weights = np.bincount(a, minlength=count) + 1.0
+        shift = np.stack([np.bincount(a, moves[:, axis], minlength=count) for axis in range(3)], axis=1)
+        shift /= weights[:, None]
+        self.positions = self.lattice_round(self.positions + shift)
+        return float(np.linalg.norm(shift, axis=1).mean() / self.scale)
+
+    def prolong(self, fine):
+        fine.positions = fine.lattice_round(self.positions[fine.clusters])
+
+
+class PositionFieldSolver:
+    # Lattice of quads of edge length scale, aligned to a solved cross field, over the same vertex hierarchy.
+    # Coarse levels sit at the mean position of their clusters. Like the cross field solver, steps() goes
+    # from the coarsest level down and positions() is usable wherever it stopped.
+    def __init__(self, cross_solver, co, scale):
+        co = np.asarray(co, dtype=np.float64)
+        weights = np.ones(len(co))
+        self.levels = []
+        for index, level in enumerate(cross_solver.levels):
+            if index > 0:
+                clusters = cross_solver.levels[index - 1].clusters
+                count = len(level.normals)
+                sums = np.stack([np.bincount(clusters, co[:, axis] * weights, minlength=count)
+                                 for axis in range(3)], axis=1)
+                weights = np.bincount(clusters, weights, minlength=count)
+                co = sums / weights[:, None]
+            self.levels.append(PositionFieldLevel(co, level.normals, level.edges, level.directions, scale))
+            self.levels[-1].clusters = level.clusters
+        self.levels[-1].clusters = None
+        self.current = len(self.levels) - 1
+
+    def steps(self, tolerance=1e-3, max_iterations=100, pool=None):
+        # Rounding to the lattice leaves some jitter, so a level is also left once a sweep improves
+        # the residual by less than tolerance.
+        for index in range(len(self.levels) - 1, -1, -1):
+            self.current = index
+            level = self.levels[index]
+            previous = np.inf
+            for iteration in range(max_iterations):
+                residual = level.sweep(pool)
+                yield index, iteration, residual
+                if residual < tolerance or previous - residual < tolerance:
+                    break
+                previous = residual
+            if index > 0:
+                level.prolong(self.levels[index - 1])
+
+    def solve(self, tolerance=1e-3, max_iterations=100, pool=None):
+        for _ in self.steps(tolerance, max_iterations, pool):
+            pass
+        return self.positions()
+
+    def positions(self):
+        for index in range(self.current, 0, -1):
+            self.levels[index].prolong(self.levels[index - 1])
+        self.current = 0
+        return self.levels[0].positions
+
+
+def extract_quads(level, max_sides=4, pool=None):
+    # Quad dominant mesh of the position field of a level, as (co, loops, loop_totals).
+    # Vertices whose lattice points coincide are collapsed, neighbours one lattice step apart are linked.
+    # Faces are the cycles of the half edges going around the links counterclockwise, only the ones
+    # of 3 to max_sides sides facing like the surface are kept.
+    edges = level.edges
+
+    def offsets(start, stop):
+        i, j = edges[start:stop, 0], edges[start:stop, 1]
+        q_i = level.directions[i]
+        q_j = align_rosy(level.directions[j], level.normals[j], q_i)
+        diff = level.positions[j] - level.positions[i]
+        sides = []
+        for q, n in ((q_i, level.normals[i]), (q_j, level.normals[j])):
+            a = np.round((q * diff).sum(axis=1) / level.scale)
+            b = np.round((np.cross(n, q) * diff).sum(axis=1) / level.scale)
+            sides.append(np.abs(a) + np.abs(b))
+        return np.where(sides[0] == sides[1], sides[0], -1)
+
+    steps = np.concatenate(map_chunks(pool, offsets, len(edges)) or [np.empty(0)])
+    clusters = np.unique(union_find(len(level.co), edges[steps == 0]), return_inverse=True)[1].ravel()
+    count = clusters.max() + 1 if len(clusters) else 0
+    sizes = np.bincount(clusters, minlength=count)
+    co = np.stack([np.bincount(clusters, level.positions[:, axis], minlength=count) for axis in range(3)], axis=1)
+    co /= np.maximum(sizes, 1)[:, None]
+    normals = np.stack([np.bincount(clusters, level.normals[:, axis], minlength=count) for axis in range(3)],
+                       axis=1)
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+
+    links = clusters[edges[steps == 1]]
+    links = np.unique(np.sort(links[links[:, 0] != links[:, 1]], axis=1), axis=0)
+    link_count = len(links)
+    source = np.concatenate((links[:, 0], links[:, 1]))
+    target = np.concatenate((links[:, 1], links[:, 0]))
+
+    # Half edges around every vertex in counterclockwise order, in any tangent frame.
+    axis = np.where((np.abs(normals[:, 0]) < 0.9)[:, None], [1.0, 0, 0], [0, 1.0, 0])
+    u = tangent(axis, normals, axis)
+    w = np.cross(normals, u)
+    d = co[target] - co[source]
+    angles = np.arctan2((d * w[source]).sum(axis=1), (d * u[source]).sum(axis=1))
+    order = np.lexsort((angles, source))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    degrees = np.bincount(source, minlength=count)
+    indptr = np.cumsum(degrees) - degrees
+
+    # The next half edge of a face turns clockwise from the way back.
+    back = (np.arange(2 * link_count) + link_count) % max(2 * link_count, 1)
+    turn = rank[back] - indptr[target]
+    following = order[indptr[target] + (turn - 1) % np.maximum(degrees[target], 1)]
+    cycles = union_find(2 * link_count, np.stack((np.arange(2 * link_count), following), axis=1))
+    sides = np.bincount(cycles, minlength=2 * link_count)
+    first = np.flatnonzero((cycles == np.arange(2 * link_count)) & (sides >= 3) & (sides <= max_sides))
+
+    loop_totals = sides[first]
+    corners = np.full((len(first), max_sides), -1)
+    current = first
+    for corner in range(max_sides):
+        corners[:, corner] = np.where(corner < loop_totals, source[current], -1)
+        current = following[current]
+    valid = corners >= 0
+    points = co[np.maximum(corners, 0)]
+    shifted = np.where(valid[:, :, None], points, points[:, :1])
+    area = np.cross(shifted, np.roll(shifted, -1, axis=1)).sum(axis=1)
+    facing = (area * normals[np.maximum(corners, 0)].sum(axis=1)).sum(axis=1) > 0
+    corners = corners[facing]
+    loop_totals = loop_totals[facing]
+    loops = corners[valid[facing]]
+
+    used, loops = np.unique(loops, return_inverse=True)
+    return co[used], loops.ravel(), loop_totals
+
+
+def surface_area(co, loops, loop_totals):
+    starts = np.cumsum(loop_totals) - loop_totals
+    fans = loop_totals - 2
+    first = np.repeat(starts, fans)
+    step = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans)
+    a, b, c = co[loops[first]], co[loops[first + step + 1]], co[loops[first + step + 2]]
+    return float(np.linalg.norm(np.cross(b - a, c - a), axis=1).sum() / 2)
+
+
+def quad_mesh(field, target_faces, threads=0, max_sides=4, tolerance=1e-3, max_iterations=100):
+    # Quad dominant remesh of the mesh of a curvature field: cross field, position field with quads of
+    # the area of the surface over target_faces, then extraction. The result is not projected back on the
+    # surface. Returns (co, loops, loop_totals) and the seconds spent in every phase.
+    timings = OrderedDict()
+    co = np.asarray(field.co, dtype=np.float64)
+    scale = np.sqrt(surface_area(co, field.loops, field.loop_totals) / max(target_faces, 1))
+
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        start = time.perf_counter()
+        cross_solver = CrossFieldSolver(field)
+        cross_solver.solve()
+        timings["orientation"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        position_solver = PositionFieldSolver(cross_solver, co, scale)
+        position_solver.solve(tolerance, max_iterations, pool)
+        timings["position"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        arrays = extract_quads(position_solver.levels[0], max_sides, pool)
+        timings["extraction"] = time.perf_counter() - start
+    return arrays, timings
+
+
+# Falloff deformation
+##################################
+
+def weighted_center(co, weights, matrix):
+    # Sum of the weighted coordinates times the matrix (a row vector product, like vector * matrix) and
+    # the sum of weights. The product is linear so it is done once on the sum.
+    total = np.dot(weights, np.c_[co, np.ones(len(co))])
+    return np.dot(total, np.array(matrix))[:3], float(weights.sum())
+
+
+def falloff_deform(rest, weights, deform):
+    # Rest positions moved by a 4x4 matrix, blended with their (n, 1) weights like a hook without falloff.
+    moved = rest.dot(deform[:3, :3].T) + deform[:3, 3]
+    return rest + (moved - rest) * weights
@@ -0,0 +1,263 @@
+# Benchmarks of the kernel that run without blender, on synthetic meshes and armatures.
+# Every kernel is timed and its peak allocation traced at a few sizes, the results go to a JSON baseline
+# that later runs compare against. From the addon folder:
+#   python kernel_benchmarks.py --output baseline.json
+#   python kernel_benchmarks.py --compare baseline.json
+# A run comparing worse than the threshold lists the regressions and exits with status 1.
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from functools import partial
+from types import SimpleNamespace
+import numpy as np
+
+try:
+    from . import kernel, implicit, voxel_remesh
+except ImportError:
+    import kernel
+    import implicit
+    import voxel_remesh
+
+
+def synthetic_bones(count, length=0.5, seed=0):
+    # A chain-ish armature: every bone starts where some previous bone ends.
+    rng = np.random.RandomState(seed)
+    bones = []
+    for i in range(count):
+        parent = bones[rng.randint(len(bones))] if bones else None
+        head = parent.tail if parent else np.zeros(3)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        tail = head + direction * length * rng.uniform(0.5, 1.5)
+        bones.append(SimpleNamespace(head=head, tail=tail, parent=parent,
+                                     head_radius=rng.uniform(0.05, 0.3),
+                                     tail_radius=rng.uniform(0.05, 0.3)))
+    return bones
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def cube_sphere(divisions, bumps=0.1):
+    # Closed quad mesh of a cube with divisions quads per side pushed on a bumpy sphere.
+    # The six faces are built apart, the shared borders are welded by position.
+    steps = np.linspace(-1, 1, divisions + 1)
+    u, v = [grid.ravel() for grid in np.meshgrid(steps, steps, indexing="ij")]
+    corners = np.arange(divisions)[:, None] * (divisions + 1) + np.arange(divisions)
+    quads = np.stack((corners, corners + divisions + 1, corners + divisions + 2, corners + 1), axis=2).reshape(-1, 4)
+    co, loops = [], []
+    for axis in range(3):
+        for side in (-1, 1):
+            points = np.empty((len(u), 3))
+            points[:, axis] = side
+            points[:, (axis + 1) % 3] = u * side
+            points[:, (axis + 2) % 3] = v
+            loops.append(quads + len(co) * len(u))
+            co.append(points)
+    co, inverse = np.unique(np.round(np.concatenate(co), 9), axis=0, return_inverse=True)
+    co /= np.linalg.norm(co, axis=1)[:, None]
+    co *= 1 + bumps * np.sin(3 * co[:, :1]) * np.sin(4 * co[:, 1:2]) * np.sin(5 * co[:, 2:])
+    loops = inverse.ravel()[np.concatenate(loops).ravel()]
+    return co.astype(np.float32), loops.astype(np.int32), np.full(len(loops) // 4, 4, dtype=np.int32)
+
+
+def face_normals(co, loops, loop_totals):
+    face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+    crosses = np.cross(co[loops], co[loops[kernel.next_loops(loop_totals)]])
+    normals = np.stack([np.bincount(face, crosses[:, axis], minlength=len(loop_totals)) for axis in range(3)],
+                       axis=1)
+    return normals / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+
+
+def curvature_field(co, loops, loop_totals):
+    return kernel.CurvatureField(co, kernel.vertex_normals(co, loops, loop_totals).astype(np.float32),
+                                 face_normals(co, loops, loop_totals).astype(np.float32), loops, loop_totals)
+
+
+class SphereProjector:
+    # Stands in for the surface of the source: points go back to the unit sphere along their direction.
+    def project(self, co, normals, chunk_size=0):
+        co /= np.linalg.norm(co, axis=1)[:, None]
+
+
+def voxel_cells(co, depth):
+    # Same cells as the remesh modifier at this octree depth, like OptimizedRemesh uses.
+    return (co.max(axis=0) - co.min(axis=0)).max() / 0.9 / 2 ** depth
+
+
+# Setups build the inputs of a case, out of the measure, and return the function to measure.
+def setup_bones(profile, count):
+    bones = synthetic_bones(count)
+    return lambda: profile.bones_to_arrays(bones, 0.05, 10, quality=2)
+
+
+def setup_polygonize(count):
+    field = implicit.CapsuleField(*kernel.bone_arrays(synthetic_bones(count)), blend=0.05)
+    return lambda: implicit.polygonize(field, 0.04)
+
+
+def setup_voxel_remesh(source, depth):
+    return lambda: voxel_remesh.remesh(*source, cell_size=voxel_cells(source[0], depth))
+
+
+def setup_voxel_queries(source, depth):
+    # The nearest triangle search alone, for every lattice point of the sparse grid within one cell.
+    cell_size = voxel_cells(source[0], depth)
+    corners = np.asarray(source[0], dtype=np.float64)[voxel_remesh.triangulate(source[1], source[2])]
+    normals = voxel_remesh.face_normals(corners)
+    grid = voxel_remesh.SparseGrid(corners, cell_size)
+    points = grid.cells(grid.point_keys) * cell_size + grid.origin
+    return lambda: grid.query(points, corners, normals, cell_size, workers=1)
+
+
+def setup_optimize(source, depth):
+    remeshed = kernel.weld_nonmanifold(*voxel_remesh.remesh(*source, cell_size=voxel_cells(source[0], depth)))
+    return lambda: kernel.optimize_topology(*remeshed, 6)
+
+
+def setup_smooth(mesh):
+    return lambda: kernel.smooth_and_project(*mesh, SphereProjector(), 3, 0.5)
+
+
+def setup_subdivide(mesh):
+    return lambda: kernel.subdivide_and_project(*mesh, SphereProjector(), 2)
+
+
+def setup_curvature(mesh):
+    return lambda: curvature_field(*mesh).choose(1500)
+
+
+def setup_cross_field(mesh):
+    field = curvature_field(*mesh)
+    return lambda: kernel.CrossFieldSolver(field).solve()
+
+
+def setup_quad_mesh(mesh):
+    field = curvature_field(*mesh)
+    return lambda: kernel.quad_mesh(field, len(field.co) // 4)
+
+
+def deform_inputs(count, seed=0):
+    rng = np.random.RandomState(seed)
+    co = rng.uniform(-1, 1, (count, 3)).astype(np.float32)
+    weights = np.where(rng.rand(count) < 0.5, 0, rng.rand(count))
+    matrix = np.eye(4)
+    matrix[:3, 3] = (0.1, 0.2, 0.3)
+    return co, weights, matrix
+
+
+def setup_center(count):
+    co, weights, matrix = deform_inputs(count)
+    return lambda: kernel.weighted_center(co, weights, matrix)
+
+
+def setup_falloff(count):
+    co, weights, matrix = deform_inputs(count)
+    active = np.flatnonzero(weights)
+    rest = co[active].astype(np.float64)
+    return lambda: kernel.falloff_deform(rest, weights[active, None], matrix)
+
+
+def cases(quick=False):
+    # (kernel, size, setup) of every benchmark, sizes are bones, octree depths, vertices or points.
+    mesh_sizes = (16, 48) if quick else (16, 48, 128)
+    bone_counts = (10, 100) if quick else (10, 100, 1000)
+    depths = (5, 6) if quick else (5, 6, 7)
+    point_counts = (10 ** 5,) if quick else (10 ** 5, 10 ** 6)
+    profile = kernel.ProfileLibrary(base=cube_sphere(1, bumps=0))
+    source = cube_sphere(32)
+
+    for count in bone_counts:
+        yield "bones_to_arrays", count, partial(setup_bones, profile, count)
+    for count in bone_counts[:2]:
+        yield "polygonize", count, partial(setup_polygonize, count)
+    for depth in depths:
+        yield "voxel_remesh", depth, partial(setup_voxel_remesh, source, depth)
+        yield "voxel_queries", depth, partial(setup_voxel_queries, source, depth)
+        yield "optimize_topology", depth, partial(setup_optimize, source, depth)
+    for divisions in mesh_sizes:
+        mesh = cube_sphere(divisions)
+        for name, setup in (("smooth_and_project", setup_smooth), ("subdivide_and_project", setup_subdivide),
+                            ("curvature_field", setup_curvature), ("cross_field", setup_cross_field),
+                            ("quad_mesh", setup_quad_mesh)):
+            yield name, len(mesh[0]), partial(setup, mesh)
+    for count in point_counts:
+        yield "weighted_center", count, partial(setup_center, count)
+        yield "falloff_deform", count, partial(setup_falloff, count)
+
+
+def measure(function, repeat=1):
+    # Best time of some untraced runs, then the peak of the bytes allocated by one traced run.
+    # Every thread of this process is traced, the voxel remesh workers included.
+    seconds = min(timed(function)[0] for _ in range(repeat))
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run(quick=False, only=None, repeat=1, log=print):
+    results = OrderedDict()
+    for name, size, setup in cases(quick):
+        if only and name not in only:
+            continue
+        seconds, peak = measure(setup(), repeat)
+        results["%s/%s" % (name, size)] = {"seconds": seconds, "peak_bytes": peak}
+        log("%-36s %10.4f s %10.1f MB" % ("%s/%s" % (name, size), seconds, peak / 2 ** 20))
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Entries slower or heavier than threshold times the baseline, as (entry, measure, ratio).
+    regressions = []
+    for entry, result in results.items():
+        reference = baseline.get(entry)
+        if not reference:
+            continue
+        for key in ("seconds", "peak_bytes"):
+            if reference[key] > 0 and result[key] / reference[key] > threshold:
+                regressions.append((entry, key, result[key] / reference[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks of the flow tools kernel.")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare the results with")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Ratio to the baseline counted as a regression")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per case, the best one counts")
+    parser.add_argument("--quick", action="store_true", help="Only the smaller sizes")
+    parser.add_argument("--only", nargs="*", help="Kernels to run, all of them by default")
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.only, args.repeat)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"platform": platform.platform(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "results": results}, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for entry, key, ratio in regressions:
+            print("regression: %s %s x%.2f" % (entry, key, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+# Checks of the kernel outputs that run without blender, next to kernel_benchmarks which only times them.
+# From the addon folder:
+#   python kernel_tests.py
+import unittest
+import numpy as np
+
+try:
+    from . import kernel, implicit, voxel_remesh
+    from .kernel_benchmarks import cube_sphere, curvature_field, deform_inputs, face_normals, voxel_cells
+except ImportError:
+    import kernel
+    import implicit
+    import voxel_remesh
+    from kernel_benchmarks import cube_sphere, curvature_field, deform_inputs, face_normals, voxel_cells
+
+
+def open_grid(size):
+    # A flat size by size grid of quads with one corner quad split in two triangles, so it has boundaries
+    # and mixed face sizes.
+    steps = np.arange(size + 1)
+    x, y = [grid.ravel() for grid in np.meshgrid(steps, steps, indexing="ij")]
+    co = np.stack((x, y, np.zeros_like(x)), axis=1).astype(np.float32)
+    corners = np.arange(size)[:, None] * (size + 1) + np.arange(size)
+    quads = np.stack((corners, corners + size + 1, corners + size + 2, corners + 1), axis=2).reshape(-1, 4)
+    a, b, c, d = quads[0]
+    loops = np.concatenate(([a, b, c, a, c, d], quads[1:].ravel()))
+    loop_totals = np.concatenate(([3, 3], np.full(len(quads) - 1, 4)))
+    return co, loops.astype(np.int32), loop_totals.astype(np.int32)
+
+
+def naive_sets(count, pairs):
+    # Smallest element of the set of every element, with a plain union find.
+    parent = list(range(count))
+
+    def root(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for a, b in pairs:
+        parent[root(a)] = root(b)
+    smallest = {}
+    for i in range(count):
+        smallest.setdefault(root(i), i)
+    return np.array([smallest[root(i)] for i in range(count)])
+
+
+def full_optimize(co, loops, loop_totals, iterations):
+    # The optimize passes over the whole mesh every time, recounting every valence and compacting after
+    # every weld, which TopologyOptimizer has to match.
+    co = np.array(co, dtype=np.float32)
+    for _ in range(iterations):
+        pairs = kernel.collapse_pairs(loops, loop_totals, kernel.valences(len(co), loops, loop_totals))
+        if not len(pairs):
+            break
+        kernel.apply_merges(co, pairs)
+        verts = np.unique(pairs)
+        unique, inverse = np.unique(co[verts], axis=0, return_inverse=True)
+        first = np.full(len(unique), len(co))
+        np.minimum.at(first, inverse.ravel(), verts)
+        target = np.arange(len(co))
+        target[verts] = first[inverse.ravel()]
+
+        loops, loop_totals, valid = kernel.clean_faces(target[loops], loop_totals)
+        face = np.repeat(np.arange(len(loop_totals)), loop_totals)
+        loops = loops[valid[face]]
+        loop_totals = loop_totals[valid]
+        alive = target == np.arange(len(co))
+        co = co[alive]
+        loops = (np.cumsum(alive) - 1)[loops]
+    return co, loops, loop_totals
+
+
+class CatmullClarkTest(unittest.TestCase):
+    def check_counts(self, co, loops, loop_totals, levels):
+        expected = kernel.subdivided_counts(len(co), len(kernel.edge_table(loops, loop_totals)), len(loop_totals),
+                                            len(loops), levels)
+        for _ in range(levels):
+            co, loops, loop_totals = kernel.catmull_clark(co, loops, loop_totals)
+        counts = (len(co), len(kernel.edge_table(loops, loop_totals)), len(loop_totals), len(loops))
+        self.assertEqual(counts, expected)
+        self.assertTrue((loop_totals == 4).all())
+        self.assertEqual(loops.max(), len(co) - 1)
+
+    def test_closed_counts(self):
+        self.check_counts(*cube_sphere(3), levels=2)
+
+    def test_open_mixed_counts(self):
+        self.check_counts(*open_grid(4), levels=2)
+
+    def test_preallocated_output(self):
+        co, loops, loop_totals = cube_sphere(3)
+        new_co = kernel.catmull_clark(co, loops, loop_totals)[0]
+        out = np.zeros((len(new_co) + 10, 3), dtype=np.float32)
+        view = kernel.catmull_clark(co, loops, loop_totals, out=out)[0]
+        np.testing.assert_array_equal(view, new_co)
+        self.assertTrue(np.shares_memory(view, out))
+
+    def test_flat_grid_stays_flat(self):
+        co = kernel.catmull_clark(*open_grid(4))[0]
+        np.testing.assert_array_equal(co[:, 2], 0)
+
+
+class WeldTest(unittest.TestCase):
+    def edge_uses(self, loops, loop_totals):
+        return np.unique(kernel.face_edges(loops, loop_totals), axis=0, return_counts=True)[1]
+
+    def test_fins_are_welded(self):
+        # Three quads on the same 0-1 edge.
+        co = np.array([[0, 0, 0], [0, 0, 1],
+                       [1, 0, 1], [1, 0, 0],
+                       [-1, 1, 1], [-1, 1, 0],
+                       [-1, -1, 1], [-1, -1, 0]], dtype=np.float32)
+        loops = np.array([0, 1, 2, 3, 0, 1, 4, 5, 0, 1, 6, 7])
+        loop_totals = np.array([4, 4, 4])
+        self.assertEqual(self.edge_uses(loops, loop_totals).max(), 3)
+
+        co, loops, loop_totals = kernel.weld_nonmanifold(co, loops, loop_totals)
+        self.assertLessEqual(self.edge_uses(loops, loop_totals).max(), 2)
+        self.assertEqual(len(co), 7)
+        self.assertEqual(loops.max(), len(co) - 1)
+        np.testing.assert_allclose(co[0], (0, 0, 0.5))
+
+    def test_manifold_is_unchanged(self):
+        mesh = cube_sphere(3)
+        for before, after in zip(mesh, kernel.weld_nonmanifold(*mesh)):
+            np.testing.assert_array_equal(before, after)
+
+
+class UnionFindTest(unittest.TestCase):
+    def test_matches_naive(self):
+        rng = np.random.RandomState(0)
+        for count, pair_count in ((1, 0), (10, 3), (200, 150), (1000, 2000)):
+            pairs = rng.randint(count, size=(pair_count, 2))
+            np.testing.assert_array_equal(kernel.union_find(count, pairs), naive_sets(count, pairs.tolist()))
+
+    def test_chain(self):
+        pairs = np.stack((np.arange(1, 100), np.arange(99)), axis=1)[::-1]
+        np.testing.assert_array_equal(kernel.union_find(100, pairs), np.zeros(100))
+
+
+class OptimizeTest(unittest.TestCase):
+    def test_incremental_matches_full(self):
+        for divisions, depth in ((6, 4), (8, 5), (12, 5)):
+            source = cube_sphere(divisions)
+            mesh = kernel.weld_nonmanifold(*voxel_remesh.remesh(*source, cell_size=voxel_cells(source[0], depth)))
+            optimizer = kernel.TopologyOptimizer(*mesh).run(6)
+            self.assertGreater(optimizer.merges, 0)
+            for incremental, full in zip(optimizer.arrays(), full_optimize(*mesh, 6)):
+                np.testing.assert_array_equal(incremental, full)
+
+    def test_nothing_to_collapse(self):
+        mesh = cube_sphere(4)
+        optimizer = kernel.TopologyOptimizer(*mesh).run(6)
+        self.assertEqual(optimizer.passes, 0)
+        for before, after in zip(mesh, optimizer.arrays()):
+            np.testing.assert_array_equal(before, after)
+
+
+class CurvatureTest(unittest.TestCase):
+    def test_field(self):
+        co, loops, loop_totals = cube_sphere(4)
+        field = curvature_field(co, loops, loop_totals)
+        vert_normals = kernel.vertex_normals(co, loops, loop_totals).astype(np.float32)
+        normals = face_normals(co, loops, loop_totals).astype(np.float32)
+        faces = np.repeat(np.arange(len(loop_totals)), loop_totals)
+        for vertex in range(len(co)):
+            # The largest difference over the faces of the vertex, the last one of equal ones.
+            vecs = normals[faces[loops == vertex]] - vert_normals[vertex]
+            lengths = (vecs * vecs).sum(axis=1)
+            expected = vecs[len(lengths) - 1 - lengths[::-1].argmax()]
+            np.testing.assert_array_equal(field.field[vertex], expected)
+
+    def test_choose_matches_stable_sort(self):
+        # Without bumps the sphere is symmetric and most scores are tied.
+        for bumps in (0.1, 0):
+            field = curvature_field(*cube_sphere(6, bumps=bumps))
+            for n in (0, 1, 7, 100, len(field.co), len(field.co) + 5):
+                expected = np.argsort(field.scores, kind="stable")[len(field.scores) - min(n, len(field.scores)):]
+                np.testing.assert_array_equal(field.choose(n), expected)
+
+    def test_face_directions(self):
+        co, loops, loop_totals = open_grid(4)
+        co[:, 2] = np.sin(co[:, 0]) * np.cos(co[:, 1])
+        field = curvature_field(co, loops, loop_totals)
+        starts = np.cumsum(loop_totals) - loop_totals
+        faces = np.arange(len(loop_totals))
+        directions = field.face_directions(faces)
+        for face in faces:
+            corners = loops[starts[face]:starts[face] + loop_totals[face]]
+            total = field.directions[corners[0]].astype(np.float64)
+            for vert in corners[1:]:
+                candidates = [field.directions[vert], -field.directions[vert], field.crosses[vert],
+                              -field.crosses[vert]]
+                dots = [np.dot(candidate, total) for candidate in candidates]
+                total = total + candidates[max(i for i in range(4) if dots[i] == max(dots))]
+            np.testing.assert_allclose(directions[face], total / len(corners), rtol=1e-6, atol=1e-7)
+
+
+class PolygonizeTest(unittest.TestCase):
+    # A spine with two arms, symmetric on X.
+    heads = np.array([[0, 0, 0], [0, 0, 1], [0.1, 0, 1], [-0.1, 0, 1]], dtype=np.float64)
+    tails = np.array([[0, 0, 1], [0, 0, 1.5], [0.8, 0, 0.9], [-0.8, 0, 0.9]], dtype=np.float64)
+    head_radii = np.array([0.2, 0.15, 0.1, 0.1])
+    tail_radii = np.array([0.15, 0.1, 0.06, 0.06])
+
+    def check_closed(self, co, faces):
+        # Every directed edge once and its reverse once: closed, manifold and consistently wound.
+        # The capsules blend into one sphere-like piece, so the Euler characteristic is 2.
+        directed = np.stack((faces, np.roll(faces, -1, axis=1)), axis=2).reshape(-1, 2)
+        self.assertEqual(len(np.unique(directed, axis=0)), len(directed))
+        edges, uses = np.unique(np.sort(directed, axis=1), axis=0, return_counts=True)
+        self.assertTrue((uses == 2).all())
+        self.assertEqual(len(co) - len(edges) + len(faces), 2)
+
+    def polygonize(self, mirror):
+        field = implicit.CapsuleField(self.heads, self.tails, self.head_radii, self.tail_radii, blend=0.05)
+        return implicit.polygonize(field, 0.04, mirror=mirror)
+
+    def test_closed(self):
+        co, faces = self.polygonize(False)
+        self.assertGreater(len(faces), 0)
+        self.check_closed(co, faces)
+
+    def test_mirrored_closed(self):
+        co, faces = self.polygonize(True)
+        self.assertGreater(len(faces), 0)
+        self.check_closed(co, faces)
+        # Both halves are exact mirrors of each other.
+        flipped = co * (-1, 1, 1)
+        np.testing.assert_array_equal(co[np.lexsort(co.T)], flipped[np.lexsort(flipped.T)])
+
+
+class DeformTest(unittest.TestCase):
+    def test_weighted_center(self):
+        co, weights, matrix = deform_inputs(500)
+        matrix[:3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 2]]
+        center, total = kernel.weighted_center(co, weights, matrix)
+        expected = sum(weight * np.dot(np.append(point, 1), matrix) for point, weight in zip(co, weights))
+        np.testing.assert_allclose(center, expected[:3], rtol=1e-6)
+        self.assertAlmostEqual(total, weights.sum())
+
+    def test_falloff_deform(self):
+        co, weights, matrix = deform_inputs(500)
+        matrix[:3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 2]]
+        rest = co.astype(np.float64)
+        moved = kernel.falloff_deform(rest, weights[:, None], matrix)
+        for point, weight, result in zip(rest, weights, moved):
+            target = np.dot(matrix, np.append(point, 1))[:3]
+            np.testing.assert_allclose(result, point + (target - point) * weight, rtol=1e-12, atol=1e-12)
+        # Zero weights stay at rest.
+        np.testing.assert_array_equal(moved[weights == 0], rest[weights == 0])
+
+
+class MirrorTest(unittest.TestCase):
+    def test_flip_name(self):
+        for name, flipped in (("arm.L", "arm.R"), ("arm_r", "arm_l"), ("leg-L", "leg-R"),
+                              ("upper arm R", "upper arm L"), ("LeftHand", "RightHand"),
+                              ("hand_right", "hand_left"), ("LEFT_foot", "RIGHT_foot"),
+                              ("spine", "spine"), ("Ball", "Ball")):
+            self.assertEqual(kernel.flip_name(name), flipped)
+
+    def bone(self, head, tail, head_radius=0.1, tail_radius=0.1):
+        return list(head) + list(tail) + [head_radius, tail_radius]
+
+    def test_pairs_and_centre(self):
+        names = ["spine", "arm.R", "arm.L"]
+        params = np.array([self.bone((0, 0, 0), (0, 0, 1)),
+                           self.bone((-0.2, 0, 1), (-1, 0, 1)),
+                           self.bone((0.2, 0, 1), (1, 0, 1))])
+        sources, mirrored, paired, center = kernel.mirror_plan(names, params)
+        self.assertEqual(paired.tolist(), [False, True, True])
+        self.assertEqual(center.tolist(), [True, False, False])
+        # The bone on the positive side is generated and mirrored, the centre bone only generated.
+        self.assertEqual(sources.tolist(), [0, 2])
+        self.assertEqual(mirrored.tolist(), [1])
+
+    def test_pairs_by_position(self):
+        names = ["a", "b"]
+        params = np.array([self.bone((-0.2, 0, 1), (-1, 0, 1)),
+                           self.bone((0.2, 0, 1), (1, 0, 1))])
+        sources, mirrored = kernel.mirror_plan(names, params)[:2]
+        self.assertEqual(sources.tolist(), [1])
+        self.assertEqual(mirrored.tolist(), [0])
+
+    def test_asymmetric_radii(self):
+        names = ["arm.L", "arm.R"]
+        params = np.array([self.bone((0.2, 0, 1), (1, 0, 1), tail_radius=0.2),
+                           self.bone((-0.2, 0, 1), (-1, 0, 1))])
+        sources, mirrored = kernel.mirror_plan(names, params)[:2]
+        self.assertEqual(sources.tolist(), [0, 1])
+        self.assertEqual(mirrored.tolist(), [])
+
+    def test_asymmetric_rig(self):
+        # A centre spine, an arm at x = 1 and an unrelated one at x = -3: nothing pairs, every bone is
+        # generated and the rig does not count as symmetric.
+        names = ["spine", "arm.L", "tail"]
+        params = np.array([self.bone((0, 0, 0), (0, 0, 1)),
+                           self.bone((0.9, 0, 1), (1.1, 0, 1)),
+                           self.bone((-2.9, 0, 1), (-3.1, 0, 1))])
+        sources, mirrored, paired, center = kernel.mirror_plan(names, params)
+        self.assertEqual(sources.tolist(), [0, 1, 2])
+        self.assertEqual(mirrored.tolist(), [])
+        self.assertEqual(paired.tolist(), [False, False, False])
+        self.assertFalse((paired | center).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
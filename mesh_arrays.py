@@ -0,0 +1,45 @@
+# Helpers to move mesh data in and out of blender as flat numpy arrays.
+# Vertex coordinates are (n, 3) float32, faces are given by the flat loop vertex indices
+# and the number of loops of each face, like blender stores them. What is done with them lives in kernel.
+import numpy as np
+import bpy
+
+
+def mesh_to_arrays(mesh):
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    loops = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loops)
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    return co.reshape(-1, 3), loops, loop_totals
+
+
+def arrays_to_mesh(mesh, co, loops, loop_totals):
+    # Fills an empty mesh from flat arrays, edges are derived from the faces.
+    loop_starts = np.cumsum(loop_totals) - loop_totals
+
+    mesh.vertices.add(len(co))
+    mesh.loops.add(len(loops))
+    mesh.polygons.add(len(loop_totals))
+
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(co, dtype=np.float32).ravel())
+    mesh.loops.foreach_set("vertex_index", np.asarray(loops, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_start", loop_starts.astype(np.int32))
+    mesh.polygons.foreach_set("loop_total", np.asarray(loop_totals, dtype=np.int32))
+
+    mesh.update(calc_edges=True)
+    return mesh
+
+
+def replace_mesh(ob, mesh):
+    # Swaps the object data for a freshly built mesh, keeping the materials, and frees the old one.
+    old = ob.data
+    if not len(mesh.materials):
+        for material in old.materials:
+            mesh.materials.append(material)
+    ob.data = mesh
+    if old.users == 0:
+        bpy.data.meshes.remove(old)
+
+
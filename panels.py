@@ -1,4 +1,46 @@
 import bpy
+from . import envelope_builder
+from .profiling import profiler, HAS_PEAKS
+
+
+def update_profiling(self, context):
+    profiler.configure(self.flow_profiling_enabled, self.flow_profiling_memory)
+
+
+# Writes what the profiler recorded so far, as is or as a Chrome trace.
+class ProfilingExport(bpy.types.Operator):
+    bl_idname = "flow_tools.profiling_export"
+    bl_label = "Export Profile"
+    bl_description = "Save the recorded spans and counters to a JSON file"
+
+    format_items = (("JSON", "JSON", "Spans, counters and a summary per span name"),
+                    ("CHROME", "Chrome Trace", "Trace events for chrome://tracing or ui.perfetto.dev"))
+
+    filepath = bpy.props.StringProperty(subtype="FILE_PATH")
+    filter_glob = bpy.props.StringProperty(default="*.json", options={"HIDDEN"})
+    format = bpy.props.EnumProperty(items=format_items, name="Format", default="JSON")
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "flow_tools_profile.json"
+        context.window_manager.fileselect_add(self)
+        return {"RUNNING_MODAL"}
+
+    def execute(self, context):
+        profiler.export(bpy.path.abspath(self.filepath), chrome=self.format == "CHROME")
+        self.report({"INFO"}, "Profile saved to %s" % self.filepath)
+        return {"FINISHED"}
+
+
+class ProfilingClear(bpy.types.Operator):
+    bl_idname = "flow_tools.profiling_clear"
+    bl_label = "Clear Profile"
+    bl_description = "Forget the recorded spans and counters"
+
+    def execute(self, context):
+        profiler.clear()
+        return {"FINISHED"}
+
 
 # Panels of the addon
 class FlowPanel(bpy.types.Panel):
@@ -17,6 +59,7 @@ class FlowPanel(bpy.types.Panel):
         col.separator()
 
         col.operator("flow_tools.optimized_remesh")
+        col.operator("sculpt_flow.auto_retopo")
         
         row = col.row(align=True)
         row.operator("flow_tools.booleans", "Union").type = "UNION"
@@ -28,8 +71,57 @@ class FlowPanel(bpy.types.Panel):
 
         col.operator("flow_tools.add_envelope")
         col.operator("flow_tools.envelope_metaball_convert")
+        col.operator("flow_tools.envelope_mesh_convert")
+        col.operator("flow_tools.envelope_profile_convert")
         col.operator("object.convert", "Convert To Mesh").target = "MESH"
 
+        ob = context.active_object
+        if ob and ob.type == "ARMATURE" and ob.data.custom_preview_envelope:
+            scheduler = envelope_builder.scheduler
+            col.prop(ob.data, "custom_preview_idle_delay")
+            col.prop(ob.data, "custom_preview_budget")
+            col.prop(ob.data, "custom_preview_quality")
+            col.label("Last rebuild: %.1f ms in %d ticks" % (scheduler.last_rebuild_time * 1000,
+                                                            scheduler.last_rebuild_ticks))
+            col.label("Coalesced: %d  Skipped: %d" % (scheduler.coalesced, scheduler.skipped))
+
         col.separator()
         col.label("Deform")
         col.operator("flow_tools.handler_deform")
+
+        col.separator()
+        self.draw_profiling(context, col)
+
+    def draw_profiling(self, context, layout):
+        wm = context.window_manager
+        expanded = wm.flow_profiling_expanded
+        layout.prop(wm, "flow_profiling_expanded", text="Profiling",
+                    icon="TRIA_DOWN" if expanded else "TRIA_RIGHT", emboss=False)
+        if not expanded:
+            return
+
+        row = layout.row(align=True)
+        row.prop(wm, "flow_profiling_enabled", toggle=True)
+        row.prop(wm, "flow_profiling_memory", toggle=True)
+
+        summary = profiler.summary()
+        if summary:
+            box = layout.box().column(align=True)
+            box.label("Span: calls, total ms, max ms")
+            for name, (calls, total, longest, memory) in summary.items():
+                box.label("%s: %d, %.1f, %.1f" % (name, calls, total * 1000, longest * 1000))
+            if profiler.memory:
+                # Without peaks only the memory a span left allocated is known.
+                box.label("%s: %.1f MB" % ("Highest peak" if HAS_PEAKS else "Most left allocated",
+                                           max(entry[3] for entry in summary.values()) / 2 ** 20))
+            if profiler.dropped:
+                box.label("Spans past the buffer: %d" % profiler.dropped)
+        if profiler.counters:
+            box = layout.box().column(align=True)
+            for name, value in profiler.counters.items():
+                box.label("%s: %d" % (name, value))
+
+        row = layout.row(align=True)
+        row.operator("flow_tools.profiling_export", "JSON").format = "JSON"
+        row.operator("flow_tools.profiling_export", "Chrome Trace").format = "CHROME"
+        layout.operator("flow_tools.profiling_clear")
@@ -0,0 +1,151 @@
+# Lightweight instrumentation of the heavy paths: named timing spans, counters and allocation tracking.
+# Spans nest, every closed one is kept with its start, duration and thread so the whole run can be
+# exported as JSON or as a Chrome trace (chrome://tracing, or https://ui.perfetto.dev). The calls, total
+# and longest time of every span name are also kept as running totals, so summaries don't walk the spans.
+# Disabled, span() hands out one shared do-nothing context and count() returns at once, so the calls
+# can stay in the hot paths. Only the standard library is used, the kernel imports this too.
+import json
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+# The peak of a span needs the traced peak reset when it starts, only possible from python 3.9. Older
+# pythons, like the one in blender 2.79, only get the memory a span leaves allocated.
+HAS_PEAKS = hasattr(tracemalloc, "reset_peak")
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if self.profiler.memory:
+            stack = self.profiler.stack
+            if HAS_PEAKS:
+                # The enclosing span keeps the peak it saw so far, resetting would lose it.
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+            self.peak = self.memory
+            stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        profiler = self.profiler
+        record = {"name": self.name, "start": self.start - profiler.origin, "duration": end - self.start,
+                  "thread": threading.get_ident()}
+        memory = 0
+        if profiler.memory and self in profiler.stack:
+            profiler.stack.remove(self)
+            current, peak = tracemalloc.get_traced_memory()
+            record["allocated"] = current - self.memory
+            if HAS_PEAKS:
+                self.peak = max(self.peak, peak)
+                record["peak"] = self.peak - self.memory
+                if profiler.stack:
+                    profiler.stack[-1].peak = max(profiler.stack[-1].peak, self.peak)
+            memory = record.get("peak", record["allocated"])
+        if self.args:
+            record["args"] = self.args
+        profiler.add(record, memory)
+        return False
+
+
+class Profiler:
+    def __init__(self, max_spans=100000):
+        self.enabled = False
+        self.memory = False
+        self.max_spans = max_spans
+        self.clear()
+
+    def configure(self, enabled, memory=False):
+        # Memory tracking starts tracemalloc, which slows every allocation down, so it is only on when asked.
+        memory = enabled and memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not memory and self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.enabled = enabled
+        self.memory = memory
+        self.stack = []
+
+    def clear(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self.totals = OrderedDict()
+        self.counters = OrderedDict()
+        self.stack = []
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def add(self, record, memory):
+        # Past max_spans the records are dropped, the totals still count them.
+        if len(self.spans) < self.max_spans:
+            self.spans.append(record)
+        else:
+            self.dropped += 1
+        calls, total, longest, most = self.totals.get(record["name"], (0, 0.0, 0.0, 0))
+        self.totals[record["name"]] = (calls + 1, total + record["duration"], max(longest, record["duration"]),
+                                       max(most, memory))
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        # Calls, total and longest seconds and the most memory of every span name, in first seen order.
+        # The memory is the highest peak over the span start, or the most left allocated without peaks.
+        return self.totals
+
+    def to_dict(self):
+        memory_key = "peak_bytes" if HAS_PEAKS else "allocated_bytes"
+        return {"spans": self.spans,
+                "dropped_spans": self.dropped,
+                "counters": self.counters,
+                "summary": OrderedDict((name, {"calls": calls, "seconds": total, "longest": longest,
+                                               memory_key: memory})
+                                       for name, (calls, total, longest, memory) in self.summary().items())}
+
+    def chrome_trace(self):
+        # Complete events in microseconds, the counters as one counter event at the end.
+        events = []
+        for record in self.spans:
+            args = dict(record.get("args", {}))
+            for key in ("allocated", "peak"):
+                if key in record:
+                    args[key] = record[key]
+            events.append({"name": record["name"], "ph": "X", "pid": 0, "tid": record["thread"],
+                           "ts": record["start"] * 1e6, "dur": record["duration"] * 1e6, "args": args})
+        if self.counters:
+            end = max([record["start"] + record["duration"] for record in self.spans] or [0])
+            events.append({"name": "counters", "ph": "C", "pid": 0, "tid": 0, "ts": end * 1e6,
+                           "args": dict(self.counters)})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path, chrome=False):
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace() if chrome else self.to_dict(), file, indent=1)
+
+
+profiler = Profiler()
@@ -1,5 +1,91 @@
+import hashlib
+from collections import OrderedDict
 import bpy
-import bmesh
+import numpy as np
+from mathutils.bvhtree import BVHTree
+from .mesh_arrays import mesh_to_arrays, arrays_to_mesh, replace_mesh
+from .kernel import weld_nonmanifold, TopologyOptimizer, smooth_and_project, subdivide_and_project
+from . import voxel_remesh
+from .profiling import profiler
+
+
+class SurfaceProjector:
+    # Projects points along their normals onto the evaluated surface of an object, both ways, keeping
+    # the nearest hit like the shrinkwrap modifier in project mode. The tree is built once and reused.
+    def __init__(self, ob, scene):
+        self.tree = BVHTree.FromObject(ob, scene)
+
+    def project(self, co, normals, chunk_size=0):
+        # In chunks, the ray casts need every point as python floats. Only these python lists are bounded
+        # by the chunk size, the arrays are whole mesh.
+        chunk_size = chunk_size or len(co)
+        for start in range(0, len(co), chunk_size):
+            self.project_chunk(co[start:start + chunk_size], normals[start:start + chunk_size])
+
+    def project_chunk(self, co, normals):
+        for i, (point, normal) in enumerate(zip(co.tolist(), normals.tolist())):
+            forward = self.tree.ray_cast(point, normal)
+            backward = self.tree.ray_cast(point, [-n for n in normal])
+            hits = [hit for hit in (forward, backward) if hit[0] is not None]
+            if hits:
+                co[i] = min(hits, key=lambda hit: hit[3])[0]
+
+
+def array_hash(*arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def surface_hash(ob, scene, source_hash):
+    # Hash of the surface the projector sees: the evaluated mesh when some modifier is on in the viewport.
+    if not any(modifier.show_viewport for modifier in ob.modifiers):
+        return source_hash
+    mesh = ob.to_mesh(scene, True, "PREVIEW")
+    try:
+        return array_hash(*mesh_to_arrays(mesh))
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+
+class StageCache:
+    # Least recently used store of stage results as tuples of arrays, under a memory cap.
+    # Keys start with the hash of the source mesh and add the parameters of every stage up to the cached
+    # one, so changing a late stage parameter reuses all the earlier results. Stages projecting on the
+    # evaluated source also add the hash of that surface.
+    # Cached arrays are read only, stages always build new arrays from them.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        arrays = self.entries.get(key)
+        if arrays is not None:
+            self.entries.move_to_end(key)
+        return arrays
+
+    def put(self, key, arrays):
+        arrays = tuple(np.asarray(array) for array in arrays)
+        for array in arrays:
+            array.flags.writeable = False
+        size = sum(array.nbytes for array in arrays)
+        if key in self.entries:
+            self.size -= sum(array.nbytes for array in self.entries.pop(key))
+        if size <= self.max_bytes:
+            self.entries[key] = arrays
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= sum(array.nbytes for array in self.entries.popitem(last=False)[1])
+        return arrays
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+stage_cache = StageCache(512 * 1024 * 1024)
 
 
 class OptimizedRemesh(bpy.types.Operator):
@@ -8,10 +94,14 @@ class OptimizedRemesh(bpy.types.Operator):
     bl_description = ""
     bl_options = {"REGISTER"}
 
+    engine_items = (("MODIFIER", "Remesh Modifier", "Octree remesh modifier"),
+                    ("VOXEL", "Sparse Voxels", "Dual contouring of a sparse voxel grid, needs a closed source"))
+
     mode_items = (("BLOCKS", "Blocks", "Blocks"),
                   ("SMOOTH", "Smooth", "Smooth"),
                   ("SHARP", "Sharp", "Sharp"))
 
+    engine = bpy.props.EnumProperty(items=engine_items, name="Engine", default="MODIFIER")
     mode = bpy.props.EnumProperty(items=mode_items, name="Mode", description="Remesh mode", default="SMOOTH")
     depth = bpy.props.IntProperty(name="Depth", default=6)
     keep_original = bpy.props.BoolProperty(name="Keep Original", default=False)
@@ -20,6 +110,12 @@ class OptimizedRemesh(bpy.types.Operator):
     optimize_iterations = bpy.props.IntProperty(name="Optimize Iterations", default=6)
     smooth_iterations = bpy.props.IntProperty(name="Smooth Iterations", default=3)
     smooth_factor = bpy.props.FloatProperty(name="Smooth Factor", default=0.5)
+    chunked_projection = bpy.props.BoolProperty(name="Chunked Projection", default=False,
+                                                description="Convert the vertices to python for the ray casts in "
+                                                            "chunks, the subdivision itself stays whole mesh")
+    chunk_size = bpy.props.IntProperty(name="Projection Chunk Size", default=65536, min=1024)
+    workers = bpy.props.IntProperty(name="Workers", default=1, min=0,
+                                    description="Threads of the voxel engine, 0 for one per cpu, 1 for none")
 
     @classmethod
     def poll(cls, context):
@@ -41,87 +137,63 @@ class OptimizedRemesh(bpy.types.Operator):
             n_ob.select = True
             context.scene.objects.link(n_ob)
             context.scene.objects.active = n_ob
-            remesh = n_ob.modifiers.new(type="REMESH", name="Remesh")
-            remesh.mode = self.mode
-            remesh.octree_depth = self.depth
-            bpy.ops.object.convert(target="MESH")
 
-            if self.optimize:
-                bm = bmesh.new()
-                bm.from_mesh(n_ob.data)
-                bm.faces.ensure_lookup_table()
-                bm.edges.ensure_lookup_table()
-                bm.verts.ensure_lookup_table()
-
-                merge_verts = set()
-                for edge in bm.edges:
-                    if len(edge.link_faces) > 2:
-                        edge.verts[0].co = (edge.verts[0].co + edge.verts[1].co)/2
-                        edge.verts[1].co = edge.verts[0].co
-                        merge_verts.add(edge.verts[0])
-                        merge_verts.add(edge.verts[1])
-
-                bmesh.ops.remove_doubles(bm, verts=list(set(merge_verts)), dist=0)
-
-                for _ in range(self.optimize_iterations):
-                    merge_verts = set()
-                    for face in bm.faces:
-                        verts = [loop.vert for loop in face.loops]
-                        link_counts = [len(vert.link_edges) for vert in verts]
-
-                        if link_counts.count(3) > 1:
-                            ok = True
-                            if link_counts[0] == 3 and link_counts[2] == 3:
-                                if len(verts[0].link_edges) > 5 or len(verts[2].link_edges) > 5:
-                                    diff = verts[0].co - verts[2].co
-                                    diff = diff*diff
-                                    if diff.x < diff.z or diff.y < diff.z:
-                                        ok = False
-                                if ok:
-                                    verts[0].co += verts[2].co
-                                    verts[0].co /= 2
-                                    verts[2].co = verts[0].co
-                                    merge_verts.add(verts[0])
-                                    merge_verts.add(verts[2])
-
-                            elif link_counts[1] == 3 and link_counts[3] == 3:
-                                ok = True
-                                if link_counts[0] == 3 and link_counts[2] == 3:
-                                    if len(verts[0].link_edges) > 5 or len(verts[2].link_edges) > 5:
-                                        diff = verts[0].co - verts[2].co
-                                        diff = diff * diff
-                                        if diff.x < diff.z or diff.y < diff.z:
-                                            ok = False
-                                if ok:
-                                    verts[1].co += verts[3].co
-                                    verts[1].co /= 2
-                                    verts[3].co = verts[1].co
-                                    merge_verts.add(verts[1])
-                                    merge_verts.add(verts[3])
-
-                    bmesh.ops.remove_doubles(bm, verts=list(set(merge_verts)), dist=0)
-
-                bm.to_mesh(n_ob.data)
-
-                for _ in range(self.smooth_iterations):
-                    sm = n_ob.modifiers.new(type="SMOOTH", name="Smth_mdfr")
-                    sm.factor = self.smooth_factor
-                    sk = n_ob.modifiers.new(type="SHRINKWRAP", name="srnk_wrp")
-                    sk.target = ob
-                    sk.wrap_method = "PROJECT"
-                    sk.use_negative_direction = True
+            source = mesh_to_arrays(ob.data)
+            remesh_key = (array_hash(*source), self.mode if self.engine == "MODIFIER" else self.engine, self.depth)
+            remeshed = stage_cache.get(remesh_key)
+            if remeshed is None and self.engine == "MODIFIER":
+                with profiler.span("remesh modifier", depth=self.depth):
+                    remesh = n_ob.modifiers.new(type="REMESH", name="Remesh")
+                    remesh.mode = self.mode
+                    remesh.octree_depth = self.depth
                     bpy.ops.object.convert(target="MESH")
+                    remeshed = stage_cache.put(remesh_key, mesh_to_arrays(n_ob.data))
+            else:
+                if remeshed is None:
+                    # Same cells as the modifier: its octree spans the largest dimension over its 0.9 scale.
+                    cell_size = (source[0].max(axis=0) - source[0].min(axis=0)).max() / 0.9 / 2 ** self.depth
+                    with profiler.span("voxel remesh", depth=self.depth):
+                        remeshed = stage_cache.put(remesh_key, voxel_remesh.remesh(*source, cell_size=cell_size,
+                                                                                   workers=self.workers,
+                                                                                   threads=True))
+                if not self.optimize:
+                    mesh = bpy.data.meshes.new(n_ob.data.name)
+                    replace_mesh(n_ob, arrays_to_mesh(mesh, *remeshed))
+
+            if self.optimize:
+                optimize_key = remesh_key + (self.optimize_iterations,)
+                optimized = stage_cache.get(optimize_key)
+                if optimized is None:
+                    profiler.count("remeshed faces", len(remeshed[2]))
+                    with profiler.span("weld nonmanifold"):
+                        co, loops, loop_totals = weld_nonmanifold(*remeshed)
+                    optimizer = TopologyOptimizer(co, loops, loop_totals).run(self.optimize_iterations)
+                    self.report({"INFO"}, "Optimized topology in %d passes, %d merges" % (optimizer.passes, optimizer.merges))
+                    optimized = stage_cache.put(optimize_key, optimizer.arrays())
+                co, loops, loop_totals = optimized
+
+                projector = None
+                chunk_size = self.chunk_size if self.chunked_projection else 0
+                if self.smooth_iterations > 0:
+                    smooth_key = optimize_key + (surface_hash(ob, context.scene, remesh_key[0]),
+                                                 self.smooth_iterations, self.smooth_factor)
+                    smoothed = stage_cache.get(smooth_key)
+                    if smoothed is None:
+                        projector = SurfaceProjector(ob, context.scene)
+                        smoothed = stage_cache.put(smooth_key, (smooth_and_project(
+                            co, loops, loop_totals, projector, self.smooth_iterations, self.smooth_factor, chunk_size),))
+                    co = smoothed[0]
 
                 if self.subdivisions > 0:
-                    n_ob.modifiers.new(type="MULTIRES", name="Multiresolution_0")
-                    for _ in range(self.subdivisions):
-                        print(bpy.ops.object.multires_subdivide(modifier="Multiresolution_0"))
-                        sk = n_ob.modifiers.new(type="SHRINKWRAP", name="Subd_skrp")
-                        sk.target = ob
-                        sk.wrap_method = "PROJECT"
-                        sk.use_negative_direction = True
-                        bpy.ops.object.modifier_apply(modifier="Subd_skrp")
-                    bpy.ops.object.multires_base_apply(modifier="Multiresolution_0")
+                    projector = projector or SurfaceProjector(ob, context.scene)
+                    co, loops, loop_totals = subdivide_and_project(co, loops, loop_totals, projector,
+                                                                   self.subdivisions, chunk_size)
+
+                with profiler.span("write mesh"):
+                    mesh = bpy.data.meshes.new(n_ob.data.name)
+                    arrays_to_mesh(mesh, co, loops, loop_totals)
+                    replace_mesh(n_ob, mesh)
+                profiler.count("vertices written", len(co))
 
             if not self.keep_original:
                 dt = ob.data
@@ -0,0 +1,410 @@
+# Sparse voxel remeshing, an alternative to the remesh modifier.
+# Only cells near the surface exist: the source triangles are sampled finer than the cells, and the cells
+# holding samples, grown by one, make a hashed grid. The sign at their corners comes from the winding number
+# of the source, so overlapping closed parts merge into their union. Distances are only needed at the ends
+# of the lattice edges crossing the surface, from the nearest of the triangles sampled in the cells around
+# them. The source should be closed.
+# The surface is extracted with dual contouring, one vertex per surface patch of every cell, so cells
+# crossed by two sheets don't pinch them together. The result is a closed, consistently oriented quad mesh,
+# manifold except where a tunnel through the surface is thinner than a cell.
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+# Corners of a cube, indexed by bits: x = 1, y = 2, z = 4.
+CORNERS = np.array([[(i >> 0) & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+
+# Cube edges as (start, end) corners, the four along x first, then y and z.
+EDGES = np.array([(c, c | 1 << axis) for axis in range(3) for c in range(8) if not c >> axis & 1])
+
+# Cube edge starting at a corner along an axis.
+EDGE_INDEX = np.full((3, 8), -1)
+for _index, (_start, _end) in enumerate(EDGES):
+    EDGE_INDEX[int(_end - _start).bit_length() - 1, _start] = _index
+
+OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])
+
+
+def _patch_table():
+    # For each of the 256 inside/outside cases of a cube, the surface patch of each of its edges,
+    # -1 for edges without a crossing, and the number of patches. Crossings are joined across the cube
+    # faces. Faces with two inside corners on a diagonal keep them apart, both cubes sharing a face
+    # agree on that so patches continue through it.
+    edge_index = {tuple(edge): i for i, edge in enumerate(EDGES.tolist())}
+    faces = []
+    for axis in range(3):
+        u, v = 1 << (axis + 1) % 3, 1 << (axis + 2) % 3
+        for side in (0, 1 << axis):
+            faces.append([side, side | u, side | u | v, side | v])
+
+    table = np.full((256, 12), -1)
+    counts = np.zeros(256, dtype=np.int64)
+    for case in range(256):
+        inside = [case >> corner & 1 for corner in range(8)]
+        parent = list(range(12))
+
+        def find(edge):
+            while parent[edge] != edge:
+                edge = parent[edge]
+            return edge
+
+        for ring in faces:
+            sides = [edge_index[tuple(sorted((ring[i], ring[(i + 1) % 4])))] for i in range(4)]
+            crossing = [i for i in range(4) if inside[ring[i]] != inside[ring[(i + 1) % 4]]]
+            if len(crossing) == 2:
+                joined = [(sides[crossing[0]], sides[crossing[1]])]
+            elif len(crossing) == 4:
+                # The sides around each inside corner.
+                joined = [(sides[i - 1], sides[i]) for i in range(4) if inside[ring[i]]]
+            else:
+                joined = []
+            for a, b in joined:
+                parent[find(a)] = find(b)
+
+        patches = {}
+        for edge, (start, end) in enumerate(EDGES):
+            if inside[start] != inside[end]:
+                table[case, edge] = patches.setdefault(find(edge), len(patches))
+        counts[case] = len(patches)
+    return table, counts
+
+
+PATCH_TABLE, PATCH_COUNTS = _patch_table()
+
+
+def triangulate(loops, loop_totals):
+    # Fan triangles of every face, as (triangles, 3) vertex indices.
+    starts = np.cumsum(loop_totals) - loop_totals
+    fans = loop_totals - 2
+    first = np.repeat(starts, fans)
+    step = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans)
+    return np.stack((loops[first], loops[first + step + 1], loops[first + step + 2]), axis=1)
+
+
+def face_normals(corners):
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    return normals / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+
+
+def closest_on_triangles(points, triangles):
+    # Squared distance and closest point for pairs of points and (points, 3, 3) triangles.
+    a = triangles[:, 0]
+    normal = np.cross(triangles[:, 1] - a, triangles[:, 2] - a)
+    length = np.linalg.norm(normal, axis=1)
+    normal /= np.maximum(length, 1e-12)[:, None]
+
+    height = ((points - a) * normal).sum(axis=1)
+    projected = points - height[:, None] * normal
+    inside = length > 0
+    for i in range(3):
+        start = triangles[:, i]
+        side = triangles[:, (i + 1) % 3] - start
+        inside &= (np.cross(side, projected - start) * normal).sum(axis=1) >= 0
+
+    distance = np.where(inside, height * height, np.inf)
+    closest = projected
+    for i in range(3):
+        start = triangles[:, i]
+        side = triangles[:, (i + 1) % 3] - start
+        t = np.clip(((points - start) * side).sum(axis=1) / np.maximum((side * side).sum(axis=1), 1e-24), 0, 1)
+        point = start + t[:, None] * side
+        squared = ((points - point) ** 2).sum(axis=1)
+        better = squared < distance
+        distance = np.where(better, squared, distance)
+        closest = np.where(better[:, None], point, closest)
+    return distance, closest
+
+
+def nearest_triangles(points, triangles, normals, rows, columns, radius):
+    # Distance to the nearest triangle and the normal of that triangle, for every point, among the
+    # candidate (rows, columns) pairs of points and triangles. Distances are capped at radius, points
+    # without candidates get radius and no normal.
+    distance = np.full(len(points), float(radius))
+    normal = np.zeros((len(points), 3))
+    if not len(rows):
+        return distance, normal
+    squared = closest_on_triangles(points[rows], triangles[columns])[0]
+    order = np.lexsort((squared, rows))
+    nearest = order[np.concatenate(([True], rows[order][1:] != rows[order][:-1]))]
+    distance[rows[nearest]] = np.minimum(np.sqrt(squared[nearest]), radius)
+    normal[rows[nearest]] = normals[columns[nearest]]
+    return distance, normal
+
+
+def query_block(task):
+    return nearest_triangles(*task)
+
+
+def sample_triangles(corners, spacing):
+    # Points on every triangle no further than spacing from any point of it, and their triangles.
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    longest = np.max([np.linalg.norm(b - a, axis=1), np.linalg.norm(c - b, axis=1),
+                      np.linalg.norm(a - c, axis=1)], axis=0)
+    steps = np.maximum(np.ceil(longest / spacing), 1).astype(np.int64)
+    points = []
+    owners = []
+    for n in np.unique(steps):
+        i, j = [grid.ravel() for grid in np.mgrid[0:n + 1, 0:n + 1]]
+        keep = i + j <= n
+        i = i[keep] / n
+        j = j[keep] / n
+        owner = np.flatnonzero(steps == n)
+        samples = (a[owner, None] + i[None, :, None] * (b - a)[owner, None]
+                   + j[None, :, None] * (c - a)[owner, None])
+        points.append(samples.reshape(-1, 3))
+        owners.append(np.repeat(owner, len(i)))
+    return np.concatenate(points), np.concatenate(owners)
+
+
+class SparseGrid:
+    # Cells and lattice points near the surface, addressed by integer keys, with the triangles sampled in
+    # every cell for the distance queries.
+    def __init__(self, corners, cell_size):
+        self.cell_size = cell_size
+        self.spacing = cell_size / 2
+        self.origin = corners.reshape(-1, 3).min(axis=0) - 2 * cell_size
+        self.dims = np.ceil((corners.reshape(-1, 3).max(axis=0) - self.origin) / cell_size).astype(np.int64) + 3
+        self.strides = np.array([self.dims[1] * self.dims[2], self.dims[2], 1])
+
+        samples, owners = sample_triangles(corners, self.spacing)
+        sample_cells = np.floor((samples - self.origin) / cell_size).astype(np.int64)
+
+        cells = np.unique(self.keys(sample_cells))
+        cells = self.cells(cells)
+        self.cell_keys = np.unique(self.keys((cells[:, None] + OFFSETS[None]).reshape(-1, 3)))
+        cells = self.cells(self.cell_keys)
+        self.point_keys = np.unique(self.keys((cells[:, None] + CORNERS[None]).reshape(-1, 3)))
+
+        # Triangles sampled in every cell, the ones of bin_keys[i] are bin_triangles[bin_starts[i]:bin_ends[i]].
+        pairs = np.unique(self.keys(sample_cells) * len(corners) + owners)
+        self.bin_keys, self.bin_starts = np.unique(pairs // len(corners), return_index=True)
+        self.bin_ends = np.append(self.bin_starts[1:], len(pairs))
+        self.bin_triangles = pairs % len(corners)
+        self.low = corners.min(axis=1)
+        self.high = corners.max(axis=1)
+
+    def keys(self, cells):
+        return cells.dot(self.strides)
+
+    def cells(self, keys):
+        return np.stack((keys // self.strides[0], keys // self.strides[1] % self.dims[1], keys % self.dims[2]),
+                        axis=1)
+
+    def lookup(self, keys, table):
+        # Index of every key in a sorted key table, -1 when missing.
+        if not len(table):
+            return np.full(len(keys), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+        return np.where(table[index] == keys, index, -1)
+
+    def candidates(self, points, radius):
+        # Pairs of points and the triangles that may come within radius of them, as (rows, triangles).
+        # Every point of a triangle is within the sample spacing of one of its samples, so those are the
+        # triangles sampled in the cells the ball of radius plus spacing around the point touches, then
+        # only the ones whose bounds come within radius.
+        reach = radius + self.spacing
+        local = (points - self.origin) / self.cell_size
+        low = np.floor(local - reach / self.cell_size).astype(np.int64)
+        span = int(np.ceil(2 * reach / self.cell_size)) + 1
+        rows = []
+        bins = []
+        for offset in np.indices((span,) * 3).reshape(3, -1).T:
+            cells = low + offset
+            # Cells of the cube around the ball but out of it are skipped.
+            gap = np.maximum(cells - local, 0) + np.maximum(local - cells - 1, 0)
+            inside = ((cells >= 0) & (cells < self.dims)).all(axis=1) & \
+                ((gap * gap).sum(axis=1) <= (reach / self.cell_size) ** 2)
+            index = self.lookup(self.keys(cells[inside]), self.bin_keys)
+            found = index >= 0
+            rows.append(np.flatnonzero(inside)[found])
+            bins.append(index[found])
+        rows = np.concatenate(rows)
+        bins = np.concatenate(bins)
+
+        counts = self.bin_ends[bins] - self.bin_starts[bins]
+        rows = np.repeat(rows, counts)
+        firsts = np.repeat(self.bin_starts[bins] - np.cumsum(counts) + counts, counts)
+        triangles = self.bin_triangles[firsts + np.arange(len(rows))]
+
+        gap = np.maximum(self.low[triangles] - points[rows], 0) + np.maximum(points[rows] - self.high[triangles], 0)
+        near = (gap * gap).sum(axis=1) <= radius * radius
+        # Triangles sampled in several of the cells show up more than once.
+        pairs = np.unique(rows[near] * len(self.low) + triangles[near])
+        return pairs // len(self.low), pairs % len(self.low)
+
+    def tasks(self, points, corners, normals, radius, chunk_size):
+        # Chunks of points, each with its candidate triangles renumbered from zero.
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            rows, triangles = self.candidates(chunk, radius)
+            used, columns = np.unique(triangles, return_inverse=True)
+            yield slice(start, start + len(chunk)), (chunk, corners[used], normals[used], rows, columns.ravel(),
+                                                     radius)
+
+    def query(self, points, corners, normals, radius, workers, threads=False, chunk_size=1 << 14):
+        # Distance to the nearest triangle and its normal for points known to be within radius of the
+        # surface, farther points get radius.
+        distance = np.empty(len(points))
+        normal = np.empty((len(points), 3))
+        groups = []
+        tasks = []
+        for group, task in self.tasks(points, corners, normals, radius, chunk_size):
+            groups.append(group)
+            tasks.append(task)
+        if workers == 1:
+            self.gather(groups, map(query_block, tasks), distance, normal)
+        else:
+            executor = ThreadPoolExecutor if threads else ProcessPoolExecutor
+            with executor(max_workers=workers or os.cpu_count()) as pool:
+                self.gather(groups, pool.map(query_block, tasks), distance, normal)
+        return distance, normal
+
+    def gather(self, groups, results, distance, normal):
+        for group, (block_distance, block_normal) in zip(groups, results):
+            distance[group] = block_distance
+            normal[group] = block_normal
+
+    def winding_numbers(self, corners):
+        # Winding number of the source around every lattice point, from the signed crossings of a ray going
+        # up in z. Points of a column share its crossings. The rays are moved off the lattice by a tiny
+        # irrational amount so they don't go exactly through triangle edges.
+        cells = self.cells(self.point_keys)
+        column_keys, point_columns = np.unique(cells[:, 0] * self.dims[1] + cells[:, 1], return_inverse=True)
+        point_columns = point_columns.ravel()
+        local = (corners - self.origin) / self.cell_size
+        xy = local[:, :, :2] - 1e-6 * np.array([np.sqrt(2), np.sqrt(3)])
+
+        # Columns inside the bounds of every triangle.
+        low = np.ceil(xy.min(axis=1)).astype(np.int64)
+        size = np.maximum(np.floor(xy.max(axis=1)).astype(np.int64) - low + 1, 0)
+        counts = size[:, 0] * size[:, 1]
+        owner = np.repeat(np.arange(len(corners)), counts)
+        index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i = low[owner, 0] + index // np.maximum(size[owner, 1], 1)
+        j = low[owner, 1] + index % np.maximum(size[owner, 1], 1)
+        column = self.lookup(i * self.dims[1] + j, column_keys)
+        keep = column >= 0
+        owner, column = owner[keep], column[keep]
+        p = np.stack((i[keep], j[keep]), axis=1).astype(np.float64)
+
+        # Edge functions give the crossing test and the barycentric weights, the one of a corner
+        # comes from the edge facing it.
+        t = xy[owner]
+        edges = [np.cross(t[:, (k + 1) % 3] - t[:, k], p - t[:, k]) for k in range(3)]
+        area = np.cross(t[:, 1] - t[:, 0], t[:, 2] - t[:, 0])
+        hit = ((edges[0] > 0) & (edges[1] > 0) & (edges[2] > 0)) | ((edges[0] < 0) & (edges[1] < 0) & (edges[2] < 0))
+        owner, column, area = owner[hit], column[hit], area[hit]
+        z = sum(edges[(m + 1) % 3][hit] * local[owner, m, 2] for m in range(3)) / area
+        # Leaving through a face pointing up adds one.
+        direction = np.sign(area)
+
+        span = self.dims[2] + 2.0
+        order = np.argsort(column * span + z, kind="stable")
+        crossings = (column * span + z)[order]
+        totals = np.concatenate(([0], np.cumsum(direction[order])))
+        point_z = cells[:, 2].astype(np.float64)
+        above = np.searchsorted(crossings, point_columns * span + point_z, side="right")
+        end = np.searchsorted(crossings, (point_columns + 1) * span, side="left")
+        return totals[end] - totals[above]
+
+
+def solve_vertices(points, normals, owners, count, low, high, bias=0.05):
+    # Dual contouring vertices: the least squares point of the tangent planes of each vertex, pulled
+    # slightly towards the mean of its crossings to stay stable on flat patches, then kept in its cell.
+    products = normals[:, :, None] * normals[:, None, :]
+    offsets = (normals * points).sum(axis=1)[:, None] * normals
+    matrices = np.stack([np.bincount(owners, products[:, i, j], minlength=count)
+                         for i in range(3) for j in range(3)], axis=1).reshape(-1, 3, 3)
+    targets = np.stack([np.bincount(owners, offsets[:, axis], minlength=count) for axis in range(3)], axis=1)
+    sizes = np.maximum(np.bincount(owners, minlength=count), 1)[:, None]
+    means = np.stack([np.bincount(owners, points[:, axis], minlength=count) for axis in range(3)], axis=1) / sizes
+
+    matrices += np.eye(3) * bias * sizes[:, :, None]
+    targets += bias * sizes * means
+    return np.clip(np.linalg.solve(matrices, targets[..., None])[..., 0], low, high)
+
+
+def empty_mesh():
+    return np.empty((0, 3), dtype=np.float32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+
+def remesh(co, loops, loop_totals, cell_size, chunk_size=1 << 14, workers=0, threads=True):
+    # Quad remesh of a closed mesh with cells of cell_size, returns the vertex, loop and face size arrays.
+    # The distance queries run in tasks of chunk_size points.
+    # workers is the number of threads for the distance queries, 0 for one per cpu, 1 runs them here.
+    # threads=False runs the workers as processes instead, only for plain python: in blender the child
+    # processes start the blender binary and cannot import this module.
+    co = np.asarray(co, dtype=np.float64)
+    triangles = triangulate(np.asarray(loops), np.asarray(loop_totals))
+    if not len(triangles):
+        return empty_mesh()
+    corners = co[triangles]
+    normals = face_normals(corners)
+    grid = SparseGrid(corners, cell_size)
+
+    points = grid.cells(grid.point_keys) * cell_size + grid.origin
+    inside = grid.winding_numbers(corners) > 0
+
+    # Surface patches of every cell with a sign change.
+    cells = grid.cells(grid.cell_keys)
+    corner_index = grid.lookup(grid.keys((cells[:, None] + CORNERS[None]).reshape(-1, 3)), grid.point_keys)
+    cases = (inside[corner_index.reshape(-1, 8)] << np.arange(8)).sum(axis=1)
+    patch_counts = PATCH_COUNTS[cases]
+    vertex_starts = np.cumsum(patch_counts) - patch_counts
+
+    # Lattice edges crossing the surface. Only their ends need distances, and the surface goes through
+    # every such edge, so those are within one cell of it.
+    crossings = []
+    for axis in range(3):
+        end = grid.lookup(grid.point_keys + grid.strides[axis], grid.point_keys)
+        start = np.flatnonzero((end >= 0) & (inside != inside[np.maximum(end, 0)]))
+        crossings.append((axis, start, end[start]))
+    ends = np.unique(np.concatenate([np.concatenate((start, end)) for axis, start, end in crossings]))
+    values = np.zeros(len(points))
+    values[ends] = np.maximum(grid.query(points[ends], corners, normals, cell_size, workers, threads,
+                                         chunk_size)[0], 1e-12)
+    values[inside] *= -1
+
+    # Crossing point and normal of every crossing edge.
+    crossing_points = []
+    for axis, start, end in crossings:
+        t = values[start] / (values[start] - values[end])
+        crossing_points.append(points[start] + (points[end] - points[start]) * t[:, None])
+    crossing_points = np.concatenate(crossing_points)
+    crossing_normals = grid.query(crossing_points, corners, normals, cell_size, workers, threads, chunk_size)[1]
+
+    # The four cells around each crossing edge, in order around its axis.
+    quads = []
+    for axis, start, end in crossings:
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        lattice = grid.cells(grid.point_keys[start])
+        around = []
+        for du, dv in ((1, 1), (0, 1), (0, 0), (1, 0)):
+            cell = grid.lookup(grid.keys(lattice - du * np.eye(3, dtype=np.int64)[u]
+                                         - dv * np.eye(3, dtype=np.int64)[v]), grid.cell_keys)
+            edge = EDGE_INDEX[axis, du << u | dv << v]
+            patch = PATCH_TABLE[cases[np.maximum(cell, 0)], edge]
+            around.append(np.where((cell >= 0) & (patch >= 0), vertex_starts[np.maximum(cell, 0)] + patch, -1))
+        around = np.stack(around, axis=1)
+        # Faces point out, the winding around the axis is reversed when the edge goes inwards.
+        outwards = inside[start]
+        around[~outwards] = around[~outwards, ::-1]
+        quads.append(around)
+    quads = np.concatenate(quads)
+    complete = (quads >= 0).all(axis=1)
+    if not complete.any():
+        return empty_mesh()
+
+    vertex_count = int(patch_counts.sum())
+    vertex_cells = np.repeat(cells, patch_counts, axis=0)
+    low = vertex_cells * cell_size + grid.origin
+    new_co = solve_vertices(np.repeat(crossing_points[complete], 4, axis=0),
+                            np.repeat(crossing_normals[complete], 4, axis=0),
+                            quads[complete].ravel(), vertex_count, low, low + cell_size)
+
+    quads = quads[complete]
+    used = np.zeros(vertex_count, dtype=bool)
+    used[quads.ravel()] = True
+    new_index = np.cumsum(used) - 1
+    return (new_co[used].astype(np.float32), new_index[quads].ravel().astype(np.int32),
+            np.full(len(quads), 4, dtype=np.int32))